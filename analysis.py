@@ -0,0 +1,122 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import utils
+from registry import encryptor_registry, metric_registry
+
+
+# 加密质量分析：NPCR/UACI、信息熵、相邻像素相关性
+# NPCR/UACI需要对只改变了一个像素的明文分别加密，并与原明文的密文比较，重复trials次
+# 这些加密按块分配给多个工作进程，每个进程对一块扰动后的明文调用encrypt_batch，所有指标都对一组图像一次计算
+
+worker_encryptor = None  # 工作进程中的加密器
+worker_rgb = None  # 工作进程中的明文
+worker_cipher = None  # 明文的密文
+
+
+def init_worker(name, args, kwargs, rgb):  # 工作进程的初始化函数，每个进程只创建一次加密器、只加密一次原明文
+    global worker_encryptor, worker_rgb, worker_cipher
+    worker_encryptor = encryptor_registry.build(name, *args, **kwargs)
+    worker_rgb = rgb
+    worker_cipher = worker_encryptor.encrypt(rgb)
+
+
+def perturb(rgb, positions):  # 返回一组明文，第i个明文只在positions[i]处的像素值加1（模256）
+    batch = np.repeat(rgb[None], len(positions), axis=0)
+    index = (np.arange(len(positions)),) + tuple(positions.T)
+    batch[index] = (batch[index].astype(np.int64) + 1) % 256
+    return batch
+
+
+def differential(positions, batch_size=16):
+    '''
+    在工作进程中计算一块扰动位置的NPCR和UACI
+    positions: shape为[n, 3]的像素位置(行, 列, 通道)
+    '''
+    npcr, uaci = metric_registry.build('NPCR'), metric_registry.build('UACI')
+    result = {'npcr': [], 'uaci': []}
+    for start in range(0, len(positions), batch_size):
+        ciphers = worker_encryptor.encrypt_batch(perturb(worker_rgb, positions[start:start + batch_size]))
+        result['npcr'].append(npcr(worker_cipher, ciphers))
+        result['uaci'].append(uaci(worker_cipher, ciphers))
+    return {key: np.concatenate(value) for key, value in result.items()}
+
+
+def summarize(values):
+    values = np.asarray(values, dtype=np.float64)
+    return {'mean': float(values.mean()), 'std': float(values.std()), 'min': float(values.min()), 'max': float(values.max())}
+
+
+def statistics(rgb):  # 单个图像的信息熵与三个方向的相邻像素相关性
+    result = {'entropy': float(metric_registry.build('Entropy')(rgb))}
+    for direction in ('horizontal', 'vertical', 'diagonal'):
+        result[f'correlation_{direction}'] = float(metric_registry.build('Correlation', direction=direction)(rgb))
+    return result
+
+
+def analyze(rgb, name, args=(), kwargs=None, trials=100, workers=None, chunk=None, seed=0):
+    '''
+    对加密器做完整的加密质量分析，返回可以保存为JSON的报告
+    name, args, kwargs: 传给encryptor_registry.build的加密器名称和参数
+    trials: NPCR/UACI的扰动次数，扰动位置由seed决定
+    chunk: 每个任务包含的扰动次数，默认使每个工作进程分到约4个任务
+    '''
+    t = time.perf_counter()
+    kwargs = kwargs or {}
+    workers = workers or os.cpu_count()
+    en = encryptor_registry.build(name, *args, **kwargs)
+    cipher = en.encrypt(rgb)
+    decrypted = en.decrypt(cipher)
+    report = {
+        'encryptor': {'name': name, 'args': list(args), 'kwargs': kwargs},
+        'shape': list(rgb.shape),
+        'roundtrip': bool(np.allclose(decrypted, rgb)),
+        'plain': statistics(rgb),
+        'cipher': statistics(cipher),
+    }
+    if trials > 0:
+        rng = np.random.default_rng(seed)
+        positions = np.stack([rng.integers(0, n, trials) for n in rgb.shape], axis=1)
+        chunk = chunk or max(1, -(-trials // (4 * workers)))
+        with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(name, tuple(args), kwargs, rgb)) as pool:
+            results = list(pool.map(differential, [positions[i:i + chunk] for i in range(0, trials, chunk)]))
+        report['trials'] = trials
+        report['npcr'] = summarize(np.concatenate([r['npcr'] for r in results]))
+        report['uaci'] = summarize(np.concatenate([r['uaci'] for r in results]))
+    report['seconds'] = time.perf_counter() - t
+    return report
+
+
+def format_report(report):
+    lines = [f'{report["encryptor"]["name"]} on {"x".join(map(str, report["shape"]))}, '
+             f'roundtrip {"ok" if report["roundtrip"] else "FAILED"}, {report["seconds"]:.2f}s']
+    for key in ('entropy', 'correlation_horizontal', 'correlation_vertical', 'correlation_diagonal'):
+        lines.append(f'  {key:24s} plain {report["plain"][key]:9.4f}  cipher {report["cipher"][key]:9.4f}')
+    for key in ('npcr', 'uaci'):
+        if key in report:
+            s = report[key]
+            lines.append(f'  {key.upper():24s} mean {s["mean"]:8.4f}%  min {s["min"]:8.4f}%  max {s["max"]:8.4f}%  '
+                         f'({report["trials"]} trials)')
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='加密质量分析')
+    parser.add_argument('image', help='明文图像，图像文件或.npy')
+    parser.add_argument('--encryptor', default='ClassicChaos', help='encryptor_registry中注册的加密器名称')
+    parser.add_argument('--args', default='[]', help='加密器的位置参数，JSON列表')
+    parser.add_argument('--kwargs', default='{}', help='加密器的关键字参数，JSON对象')
+    parser.add_argument('--trials', type=int, default=100, help='NPCR/UACI的扰动次数')
+    parser.add_argument('--workers', type=int, default=None, help='工作进程数，默认为CPU核数')
+    parser.add_argument('--seed', type=int, default=0, help='决定扰动位置的随机种子')
+    parser.add_argument('--output', default=None, help='保存报告的JSON文件')
+    opt = parser.parse_args()
+    report = analyze(utils.read_array(opt.image), opt.encryptor, json.loads(opt.args), json.loads(opt.kwargs),
+                     opt.trials, opt.workers, seed=opt.seed)
+    print(format_report(report))
+    if opt.output:
+        with open(opt.output, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -1,68 +1,69 @@
 import numpy as np
-import random
 from registry import attacker_registry
 
 class BaseAttacker:  # Attacker的基类
-    def __init__(self, times=1):
+    def __init__(self, times=1, seed=None):
+        '''
+        times: 攻击的次数
+        seed: 随机种子，每个Attacker使用自己的随机数发生器，相同的种子得到相同的攻击
+        '''
         self.times = times
+        self.rng = np.random.default_rng(seed)
 
-    def __call__(self, rgb):
+    def __call__(self, rgb, inplace=False):
+        '''
+        rgb: shape为[H, W, C]的图像，或shape为[N, H, W, C]的一组图像（所有图像受到相同位置的攻击）
+        inplace: 是否直接修改rgb，为False时先复制一份
+        '''
+        attacked = rgb if inplace else rgb.copy()
+        self.attack(attacked)
+        return attacked
+
+    def attack(self, rgb):  # 直接在rgb上执行攻击，所有位置一次生成
         pass
 
 
+def chain(rgb, attackers):  # 依次执行多个攻击，只复制一次图像
+    attacked = rgb.copy()
+    for attacker in attackers:
+        attacker(attacked, inplace=True)
+    return attacked
+
+
 @attacker_registry.register('PointReplace')
-class PointReplaceAttacker(BaseAttacker):  # 随机替换一个像素点
-    def __call__(self, rgb):
-        attacked = rgb.copy()
-        for _ in range(self.times):  # 执行self.times次替换
-            x = random.randint(0, rgb.shape[0] - 1)
-            y = random.randint(0, rgb.shape[1] - 1)
-            z = random.randint(0, rgb.shape[2] - 1)
-            attacked[x, y, z] = random.randint(0, 255)
-        return attacked
-    
+class PointReplaceAttacker(BaseAttacker):  # 随机替换像素点，执行self.times次
+    def attack(self, rgb):
+        H, W, C = rgb.shape[-3:]
+        x = self.rng.integers(0, H, self.times)
+        y = self.rng.integers(0, W, self.times)
+        z = self.rng.integers(0, C, self.times)
+        rgb[..., x, y, z] = self.rng.integers(0, 256, self.times)
+
 @attacker_registry.register('RowErase')
-class RowEraseAttacker(BaseAttacker):  # 随机擦除一行，即把一行置黑
-    def __call__(self, rgb):
-        attacked = rgb.copy()
-        for _ in range(self.times):  # 执行self.times次替换
-            x = random.randint(0, rgb.shape[0] - 1)
-            attacked[x, :, :] = np.zeros((rgb.shape[1], rgb.shape[2]))
-        return attacked
+class RowEraseAttacker(BaseAttacker):  # 随机擦除行，即把一行置黑，执行self.times次
+    def attack(self, rgb):
+        rgb[..., self.rng.integers(0, rgb.shape[-3], self.times), :, :] = 0
 
 
 @attacker_registry.register('ColumnErase')
-class RowEraseAttacker(BaseAttacker):  # 随机擦除一列，即把一列置黑
-    def __call__(self, rgb):
-        attacked = rgb.copy()
-        for _ in range(self.times):  # 执行self.times次替换
-            y = random.randint(0, rgb.shape[1] - 1)
-            attacked[:, y, :] = np.zeros((rgb.shape[0], rgb.shape[2]))
-        return attacked
+class ColumnEraseAttacker(BaseAttacker):  # 随机擦除列，即把一列置黑，执行self.times次
+    def attack(self, rgb):
+        rgb[..., :, self.rng.integers(0, rgb.shape[-2], self.times), :] = 0
 
 
 @attacker_registry.register('BlockSwap')
-class BlockSwapAttacker(BaseAttacker):  # 将图像的两个块进行交换
-    def __init__(self, times=1, block_size=10):
-        super().__init__(times)
+class BlockSwapAttacker(BaseAttacker):  # 将图像的两个块进行交换，执行self.times次
+    def __init__(self, times=1, block_size=10, seed=None):
+        super().__init__(times, seed)
         self.block_size = block_size
 
-    def __call__(self, rgb):
-        attacked = rgb.copy()
-        for _ in range(self.times):  # 执行self.times次交换
-            h, w, c = rgb.shape
-            # 随机选择两个块的位置
-            x1 = random.randint(0, h - self.block_size)
-            y1 = random.randint(0, w - self.block_size)
-            x2 = random.randint(0, h - self.block_size)
-            y2 = random.randint(0, w - self.block_size)
-
-            # 提取两个块
-            block1 = attacked[x1:x1 + self.block_size, y1:y1 + self.block_size, :].copy()
-            block2 = attacked[x2:x2 + self.block_size, y2:y2 + self.block_size, :].copy()
-
-            # 交换两个块
-            attacked[x1:x1 + self.block_size, y1:y1 + self.block_size, :] = block2
-            attacked[x2:x2 + self.block_size, y2:y2 + self.block_size, :] = block1
-
-        return attacked
\ No newline at end of file
+    def attack(self, rgb):
+        h, w = rgb.shape[-3:-1]
+        b = self.block_size
+        # 一次生成所有块的位置，每行为(x1, y1, x2, y2)
+        corners = np.stack([self.rng.integers(0, h - b + 1, self.times), self.rng.integers(0, w - b + 1, self.times),
+                            self.rng.integers(0, h - b + 1, self.times), self.rng.integers(0, w - b + 1, self.times)], axis=1)
+        for x1, y1, x2, y2 in corners:  # 两个块可能重叠，按顺序交换
+            block1 = rgb[..., x1:x1 + b, y1:y1 + b, :].copy()
+            rgb[..., x1:x1 + b, y1:y1 + b, :] = rgb[..., x2:x2 + b, y2:y2 + b, :]
+            rgb[..., x2:x2 + b, y2:y2 + b, :] = block1
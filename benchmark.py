@@ -0,0 +1,287 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+import numpy as np
+import encrypt
+import trans
+import sequence
+from registry import encryptor_registry, operation_registry
+
+
+# 性能测试：覆盖encryptor_registry中的所有加密器以及operation_registry中的每个操作
+# 使用随机生成的图像，按图像大小和通道数组成的矩阵逐个测试
+# 每个测试记录吞吐量(MB/s)、延迟分位数、tracemalloc统计的峰值内存，以及编译加密计划与执行计划（加密操作为序列生成与执行操作）各自的耗时
+
+# 构建加密器/操作时需要的参数，未列出的使用默认参数
+ENCRYPTOR_ARGS = {
+    'BaseRandom': (2024,),
+    'ClassicRandom': (2024,),
+}
+
+OPERATION_ARGS = {
+    'Compositional': lambda: ([operation_registry.build('ColumnShuffle', times=3),
+                               operation_registry.build('RowShuffle', times=3),
+                               operation_registry.build('Diffusion', times=3)],),
+    'BitPlane': lambda: ([operation_registry.build('ColumnShuffle', times=3),
+                          operation_registry.build('RowShuffle', times=3),
+                          operation_registry.build('Diffusion', times=3)],),
+    'WaveletSubband': lambda: ([operation_registry.build('ColumnShuffle', times=3),
+                                operation_registry.build('RowShuffle', times=3)],),
+}
+
+
+def build_encryptor(name):
+    return encryptor_registry.build(name, *ENCRYPTOR_ARGS.get(name, ()))
+
+
+def build_operation(name):
+    args = OPERATION_ARGS.get(name)
+    return operation_registry.build(name, *(args() if args else ()))
+
+
+def synthetic_image(size, channels, seed=0):  # 随机生成的uint8图像
+    return np.random.default_rng(seed).integers(0, 256, (size, size, channels), dtype=np.uint8)
+
+
+def measure(func, repeat):  # 执行repeat次，返回每次的耗时
+    latencies = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - t)
+    return latencies
+
+
+def peak_memory(func):  # 用tracemalloc统计执行一次func的峰值内存
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def summarize(latencies, nbytes):
+    latencies = np.array(latencies)
+    p50 = float(np.percentile(latencies, 50))
+    return {
+        'mb_per_s': nbytes / p50 / 2**20 if p50 > 0 else float('inf'),
+        'latency': {
+            'mean': float(latencies.mean()),
+            'p50': p50,
+            'p90': float(np.percentile(latencies, 90)),
+            'p99': float(np.percentile(latencies, 99)),
+        },
+    }
+
+
+def bench_encryptor(name, rgb, repeat, memory=True):
+    en = build_encryptor(name)
+    result = summarize(measure(lambda: en.encrypt(rgb), repeat), rgb.nbytes)
+    if isinstance(en, encrypt.BaseSequenceEncryptor):
+        # 与encrypt实际执行的过程相同：分别统计编译加密计划（包括生成序列与融合）和执行缓存的计划的耗时
+        result['compile_seconds'] = float(np.median(measure(lambda: en.compile(rgb.shape), repeat)))
+        plan = en.get_plan(rgb.shape)
+        result['apply_seconds'] = float(np.median(measure(lambda: plan.encrypt(rgb), repeat)))
+        result['plan_steps'], result['plan_passes'] = len(plan.steps), plan.passes()
+    else:
+        result['keystream_seconds'] = 0.0
+        result['apply_seconds'] = result['latency']['p50']
+    if memory:
+        result['peak_bytes'] = peak_memory(lambda: en.encrypt(rgb))
+    return result
+
+
+def bench_operation(name, rgb, repeat, memory=True):
+    op = build_operation(name)
+    if isinstance(op, trans.BaseTransform):
+        rgb = rgb.astype(float)
+    system = build_encryptor('ClassicChaos').sys  # 操作所需的序列由混沌系统生成
+    cost = op.get_cost(rgb)
+    keys = system.get_keystream(cost)
+    apply = lambda: op(rgb.copy(), sequence.KeyStream(keys))
+    result = summarize(measure(apply, repeat), rgb.nbytes)
+    result['keystream_seconds'] = float(np.median(measure(lambda: system.get_keystream(cost), repeat))) if cost else 0.0
+    result['apply_seconds'] = result['latency']['p50']
+    if memory:
+        result['peak_bytes'] = peak_memory(apply)
+    return result
+
+
+STARTUP_SCRIPT = '''
+import sys, time
+t = time.perf_counter()
+from registry import encryptor_registry
+encryptor_registry.build({name!r}, *{args!r})
+print(time.perf_counter() - t)
+print(' '.join(m for m in {heavy!r} if m in sys.modules))
+'''
+HEAVY_MODULES = ('scipy', 'pywt', 'skimage', 'PIL')  # 启动时不应导入的较重依赖
+
+
+def startup(name='ClassicRandom', repeat=5, budget=0.5):
+    '''
+    启动开销：在新的解释器中导入registry并构建加密器的耗时（不含解释器本身的启动），取repeat次的中位数
+    同时记录构建过程中导入的较重依赖，超过budget秒时ok为False
+    '''
+    script = STARTUP_SCRIPT.format(name=name, args=tuple(ENCRYPTOR_ARGS.get(name, ())), heavy=HEAVY_MODULES)
+    seconds, modules = [], set()
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', script], cwd=os.path.dirname(os.path.abspath(__file__)),
+                             capture_output=True, text=True, check=True).stdout.splitlines()
+        seconds.append(float(out[0]))
+        modules.update(out[1].split() if len(out) > 1 else [])
+    median = float(np.median(seconds))
+    return {'name': name, 'seconds': median, 'budget': budget, 'ok': median <= budget, 'heavy_modules': sorted(modules)}
+
+
+def format_startup(result):
+    return (f'startup   {result["name"]:28s} {result["seconds"] * 1000:9.2f} ms  budget {result["budget"] * 1000:.0f} ms  '
+            f'{"ok" if result["ok"] else "OVER BUDGET"}  heavy modules: {", ".join(result["heavy_modules"]) or "none"}')
+
+
+def canonical(registry):  # 注册的名称中去掉别名（如RawDiscreteCosineTransform），每个类只测试一次
+    return [name for name in registry.names() if registry.name_of(registry.get_class(name)) == name]
+
+
+def check_registry():  # 检查所有声明的加密器名称都对应BaseEncryptor的子类，返回不符合的名称及其对应的类
+    return encryptor_registry.verify(encrypt.BaseEncryptor)
+
+
+def format_registry(wrong):
+    return 'registry  ' + ('ok' if not wrong else ', '.join(f'{name} -> {cls!r}' for name, cls in wrong.items()))
+
+
+def run(sizes=(64, 128, 256), channels=(1, 3), repeat=3, encryptors=None, operations=None, memory=True, verbose=True, budget=0.5):
+    '''
+    执行所有测试，返回可以保存为JSON的结果
+    encryptors, operations: 要测试的加密器/操作名称，默认为注册的全部
+    budget: 启动开销的上限（秒）
+    '''
+    wrong = check_registry()
+    if wrong:
+        raise TypeError(format_registry(wrong))
+    start = startup(repeat=repeat, budget=budget)
+    if verbose:
+        print(format_startup(start))
+    cases = [('encryptor', name) for name in (encryptors if encryptors is not None else canonical(encryptor_registry))]
+    cases += [('operation', name) for name in (operations if operations is not None else canonical(operation_registry))]
+    results = []
+    for kind, name in cases:
+        for size in sizes:
+            for channel in channels:
+                rgb = synthetic_image(size, channel)
+                entry = {'kind': kind, 'name': name, 'shape': list(rgb.shape)}
+                try:
+                    bench = bench_encryptor if kind == 'encryptor' else bench_operation
+                    entry.update(bench(name, rgb, repeat, memory))
+                except Exception as e:  # 不支持该输入的加密器/操作记录错误后继续
+                    entry['error'] = f'{e.__class__.__name__}: {str(e).splitlines()[0] if str(e) else ""}'
+                results.append(entry)
+                if verbose:
+                    print(format_entry(entry))
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'repeat': repeat,
+        },
+        'startup': start,
+        'results': results,
+    }
+
+
+def format_entry(entry):
+    head = f'{entry["kind"]:9s} {entry["name"]:28s} {"x".join(map(str, entry["shape"])):12s}'
+    if 'error' in entry:
+        return f'{head} error: {entry["error"]}'
+    text = (f'{head} {entry["mb_per_s"]:9.2f} MB/s  p50 {entry["latency"]["p50"] * 1000:9.2f} ms  '
+            f'p99 {entry["latency"]["p99"] * 1000:9.2f} ms  '
+            f'{"compile" if "compile_seconds" in entry else "keystream"} '
+            f'{entry.get("compile_seconds", entry.get("keystream_seconds")) * 1000:9.2f} ms  '
+            f'apply {entry["apply_seconds"] * 1000:9.2f} ms')
+    if 'peak_bytes' in entry:
+        text += f'  peak {entry["peak_bytes"] / 2**20:8.2f} MB'
+    if 'plan_passes' in entry:
+        text += f'  plan {entry["plan_steps"]} steps / {entry["plan_passes"]:g} passes'
+    return text
+
+
+def compare(baseline, current, threshold=0.1, min_delta=1e-3):
+    '''
+    对比两次测试的结果，p50延迟比基线慢threshold以上、且至少慢min_delta秒的视为性能退化
+    min_delta用于忽略耗时极短的测试中的计时噪声
+    返回退化的测试列表
+    '''
+    base = {(e['kind'], e['name'], tuple(e['shape'])): e for e in baseline['results'] if 'error' not in e}
+    regressions = []
+    for entry in current['results']:
+        key = (entry['kind'], entry['name'], tuple(entry['shape']))
+        if 'error' in entry or key not in base:
+            continue
+        old, new = base[key]['latency']['p50'], entry['latency']['p50']
+        ratio = new / old if old > 0 else float('inf')
+        if ratio > 1 + threshold and new - old > min_delta:
+            regressions.append({'kind': key[0], 'name': key[1], 'shape': list(key[2]),
+                                'baseline_p50': old, 'current_p50': new, 'ratio': ratio})
+    if 'startup' in baseline and 'startup' in current:  # 启动开销单独对比
+        old, new = baseline['startup']['seconds'], current['startup']['seconds']
+        ratio = new / old if old > 0 else float('inf')
+        if ratio > 1 + threshold and new - old > min_delta:
+            regressions.append({'kind': 'startup', 'name': current['startup']['name'], 'shape': [],
+                                'baseline_p50': old, 'current_p50': new, 'ratio': ratio})
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='加密器与加密操作的性能测试')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('run', help='执行性能测试')
+    p.add_argument('--sizes', type=int, nargs='+', default=[64, 128, 256], help='图像边长')
+    p.add_argument('--channels', type=int, nargs='+', default=[1, 3], help='通道数')
+    p.add_argument('--repeat', type=int, default=3, help='每个测试重复的次数')
+    p.add_argument('--encryptors', nargs='*', default=None, help='要测试的加密器，默认为全部')
+    p.add_argument('--operations', nargs='*', default=None, help='要测试的操作，默认为全部')
+    p.add_argument('--no-memory', action='store_true', help='不统计峰值内存')
+    p.add_argument('--budget', type=float, default=0.5, help='启动开销的上限（秒）')
+    p.add_argument('--output', default=None, help='保存结果的JSON文件')
+    p = sub.add_parser('startup', help='只测试启动开销，并检查注册的加密器，超过上限或有错误时返回1')
+    p.add_argument('--encryptor', default='ClassicRandom')
+    p.add_argument('--repeat', type=int, default=5)
+    p.add_argument('--budget', type=float, default=0.5, help='启动开销的上限（秒）')
+    p = sub.add_parser('compare', help='与保存的基线对比')
+    p.add_argument('baseline', help='基线的JSON文件')
+    p.add_argument('current', help='本次结果的JSON文件')
+    p.add_argument('--threshold', type=float, default=0.1, help='p50延迟增加超过该比例视为退化')
+    p.add_argument('--min-delta', type=float, default=1e-3, help='p50延迟至少增加该秒数才视为退化')
+    opt = parser.parse_args()
+
+    if opt.command == 'run':
+        report = run(opt.sizes, opt.channels, opt.repeat, opt.encryptors, opt.operations, not opt.no_memory,
+                     budget=opt.budget)
+        if opt.output:
+            with open(opt.output, 'w') as f:
+                json.dump(report, f, indent=2)
+    elif opt.command == 'startup':
+        result = startup(opt.encryptor, opt.repeat, opt.budget)
+        wrong = check_registry()
+        print(format_startup(result))
+        print(format_registry(wrong))
+        sys.exit(0 if result['ok'] and not wrong else 1)
+    else:
+        with open(opt.baseline) as f:
+            baseline = json.load(f)
+        with open(opt.current) as f:
+            current = json.load(f)
+        regressions = compare(baseline, current, opt.threshold, opt.min_delta)
+        for r in regressions:
+            print(f'REGRESSION {r["kind"]} {r["name"]} {"x".join(map(str, r["shape"]))}: '
+                  f'{r["baseline_p50"] * 1000:.2f} ms -> {r["current_p50"] * 1000:.2f} ms ({r["ratio"]:.2f}x)')
+        print(f'{len(regressions)} regression(s)')
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,141 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing import shared_memory
+import numpy as np
+import utils
+import sequence
+from registry import encryptor_registry
+
+
+# 批量加密/解密整个目录
+# 主进程读取图像并放入共享内存，工作进程从共享内存读取图像、加密/解密后直接写出文件
+# 每个工作进程只在启动时通过encryptor_registry.build创建一次加密器，之后的所有文件都复用它
+
+IMAGE_SUFFIXES = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff', '.npy')
+
+worker_encryptor = None  # 工作进程中的加密器
+
+
+def init_worker(name, args, kwargs, keystore=None):  # 工作进程的初始化函数
+    global worker_encryptor
+    worker_encryptor = encryptor_registry.build(name, *args, **kwargs)
+    if keystore is not None:  # 所有工作进程共用磁盘上的密钥流，只有第一个进程需要生成
+        worker_encryptor.sys.cache = sequence.KeystreamStore(keystore)
+
+
+def process_file(shm_name, shape, dtype, dst, decrypt):
+    '''
+    在工作进程中加密/解密一个文件
+    单个文件失败时返回错误信息而不是抛出异常，不影响进程池中的其他文件
+    '''
+    t = time.perf_counter()
+    try:
+        shm = shared_memory.SharedMemory(name=shm_name)
+        try:
+            rgb = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+            result = worker_encryptor.decrypt(rgb) if decrypt else worker_encryptor.encrypt(rgb)
+            del rgb  # 释放对共享内存的引用后才能关闭
+        finally:
+            shm.close()
+        if decrypt:  # 解密结果还原为uint8图像
+            result = np.clip(np.round(np.real(result)), 0, 255).astype(np.uint8)
+        os.makedirs(os.path.dirname(dst) or '.', exist_ok=True)
+        dst = utils.save_array(result, dst)
+        return {'ok': True, 'dst': dst, 'seconds': time.perf_counter() - t}
+    except Exception as e:
+        return {'ok': False, 'error': f'{e.__class__.__name__}: {e}', 'seconds': time.perf_counter() - t}
+
+
+def find_images(src):  # 递归查找目录下的所有图像，返回相对路径
+    for root, _, files in os.walk(src):
+        for file in sorted(files):
+            if file.lower().endswith(IMAGE_SUFFIXES):
+                yield os.path.relpath(os.path.join(root, file), src)
+
+
+def process_directory(src, dst, name, args=(), kwargs=None, decrypt=False, workers=None, max_pending=None, keystore=None):
+    '''
+    加密/解密src目录下的所有图像，结果按相同的相对路径写入dst目录
+    name, args, kwargs: 传给encryptor_registry.build的加密器名称和参数
+    max_pending: 同时放在共享内存中的文件数上限，默认为工作进程数的两倍
+    keystore: 保存密钥流的目录，指定时所有工作进程通过sequence.KeystreamStore共用密钥流
+    按完成的顺序逐个返回每个文件的结果
+    '''
+    workers = workers or os.cpu_count()
+    max_pending = max_pending or 2 * workers
+    files = find_images(src)
+    pending = {}  # future -> (相对路径, 共享内存, 文件字节数)
+    with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(name, tuple(args), kwargs or {}, keystore)) as pool:
+        while True:
+            for path in files:  # 补充任务直到达到上限
+                result = {'path': path}
+                try:
+                    rgb = utils.read_array(os.path.join(src, path))
+                except Exception as e:
+                    yield {**result, 'ok': False, 'error': f'{e.__class__.__name__}: {e}', 'seconds': 0.0, 'bytes': 0}
+                    continue
+                shm = shared_memory.SharedMemory(create=True, size=max(rgb.nbytes, 1))
+                np.ndarray(rgb.shape, dtype=rgb.dtype, buffer=shm.buf)[...] = rgb
+                future = pool.submit(process_file, shm.name, rgb.shape, rgb.dtype.str, os.path.join(dst, path), decrypt)
+                pending[future] = (path, shm, rgb.nbytes)
+                if len(pending) >= max_pending:
+                    break
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path, shm, nbytes = pending.pop(future)
+                shm.close()
+                shm.unlink()
+                try:
+                    result = future.result()
+                except Exception as e:  # 工作进程异常退出
+                    result = {'ok': False, 'error': f'{e.__class__.__name__}: {e}', 'seconds': 0.0}
+                result.update(path=path, bytes=nbytes)
+                result['throughput'] = nbytes / result['seconds'] / 2**20 if result['ok'] and result['seconds'] > 0 else 0.0
+                yield result
+
+
+def run(src, dst, name, args=(), kwargs=None, decrypt=False, workers=None, verbose=True, keystore=None):
+    # 处理整个目录并汇总吞吐量，返回每个文件的结果以及汇总信息
+    t = time.perf_counter()
+    results = []
+    for result in process_directory(src, dst, name, args, kwargs, decrypt, workers, keystore=keystore):
+        results.append(result)
+        if verbose:
+            if result['ok']:
+                print(f'{result["path"]}: {result["seconds"]:.3f}s, {result["throughput"]:.2f} MB/s')
+            else:
+                print(f'{result["path"]}: failed, {result["error"]}')
+    seconds = time.perf_counter() - t
+    total = sum(r['bytes'] for r in results if r['ok'])
+    summary = {
+        'files': len(results),
+        'failed': sum(not r['ok'] for r in results),
+        'bytes': total,
+        'seconds': seconds,
+        'throughput': total / seconds / 2**20 if seconds > 0 else 0.0,  # MB/s
+        'files_per_second': len(results) / seconds if seconds > 0 else 0.0,
+    }
+    if verbose:
+        print(f'{summary["files"]} files ({summary["failed"]} failed), {summary["seconds"]:.3f}s, '
+              f'{summary["throughput"]:.2f} MB/s, {summary["files_per_second"]:.2f} files/s')
+    return results, summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='批量加密/解密目录下的所有图像')
+    parser.add_argument('mode', choices=['encrypt', 'decrypt'])
+    parser.add_argument('src', help='输入目录')
+    parser.add_argument('dst', help='输出目录')
+    parser.add_argument('--encryptor', default='ClassicChaos', help='encryptor_registry中注册的加密器名称')
+    parser.add_argument('--args', default='[]', help='加密器的位置参数，JSON列表')
+    parser.add_argument('--kwargs', default='{}', help='加密器的关键字参数，JSON对象')
+    parser.add_argument('--workers', type=int, default=None, help='工作进程数，默认为CPU核数')
+    parser.add_argument('--keystore', default=None, help='保存密钥流的目录，工作进程共用其中的密钥流')
+    opt = parser.parse_args()
+    run(opt.src, opt.dst, opt.encryptor, json.loads(opt.args), json.loads(opt.kwargs),
+        decrypt=opt.mode == 'decrypt', workers=opt.workers, keystore=opt.keystore)
@@ -0,0 +1,200 @@
+import argparse
+import json
+import struct
+import numpy as np
+import utils
+from registry import encryptor_registry
+
+
+# 密文容器：保存任意dtype的密文（包括变换域上的float64/complex128密文），之后可以从文件解密
+# 文件格式：8字节的标识 + 8字节小端序的头部长度 + JSON头部 + 填充到ALIGN字节边界 + 数据
+# 数据为按C顺序排列的原始数组，可以直接用np.memmap打开，逐帧解密时每次只读入一帧
+# 头部：{"version": 1, "shape": 密文的shape, "dtype": 密文的dtype, "encryptor": 加密器注册的名称,
+#       "operations": 加密操作的描述（见BaseOperation.describe）, "nonces": 每帧的nonce或null,
+#       "storage": {"kind": "raw" | "float16" | "quantized", "dtype": 数据的dtype, "shape": 数据的shape,
+#                   "scale": 每个通道的缩放, "offset": 每个通道的偏移}, "offset": 数据在文件中的偏移}
+# 头部中只有加密器的名称与操作的结构和参数，不包含种子、混沌初值等密钥，解密时需要传入用同一密钥创建的加密器
+
+MAGIC = b'IMGENC1\0'
+LENGTH = struct.Struct('<Q')
+ALIGN = 4096  # 数据按页对齐
+RUNTIME_PARAMS = ('workers',)  # 只影响执行方式、不影响结果的参数，检查操作是否一致时忽略
+
+
+def describe(encryptor):  # 加密器中加密操作的描述，不是基于序列发生器的加密器返回None
+    ops = getattr(encryptor, 'ops', None)
+    return [op.describe() for op in ops] if ops is not None else None
+
+
+def strip(operations):  # 去掉RUNTIME_PARAMS后用于比较
+    if operations is None:
+        return None
+    return [{'name': op['name'], 'params': {k: v for k, v in op['params'].items() if k not in RUNTIME_PARAMS},
+             'ops': strip(op.get('ops'))} for op in operations]
+
+
+def to_real(rgb):  # 复数数组在最后增加一个长度为2的轴(实部, 虚部)
+    if np.iscomplexobj(rgb):
+        return np.stack([rgb.real, rgb.imag], axis=-1)
+    return rgb
+
+
+def encode(rgb, storage='raw', bits=16):
+    '''
+    把密文转换为保存的数组，返回(数组, 头部中的storage)
+    storage: raw为原样保存（可以精确解密）；float16为半精度浮点数；quantized为按通道线性量化为bits位无符号整数
+             后两者只用于浮点/复数密文，会损失精度，解密结果是近似的
+    '''
+    if storage == 'raw':
+        data = rgb
+        info = {'kind': 'raw'}
+    else:
+        if not np.issubdtype(rgb.dtype, np.inexact):
+            raise ValueError(f'{storage} storage is lossy and only applies to float or complex ciphers, got {rgb.dtype}')
+        real = to_real(rgb)
+        if storage == 'float16':
+            if real.size and np.abs(real).max() > np.finfo(np.float16).max:  # 如未归一化的傅立叶变换的直流分量
+                raise ValueError('cipher exceeds the float16 range, use quantized storage instead')
+            data = real.astype(np.float16)
+            info = {'kind': 'float16'}
+        elif storage == 'quantized':
+            if bits not in (8, 16):
+                raise ValueError(f'quantized storage supports 8 or 16 bits, got {bits}')
+            channel = len(rgb.shape) - 1  # 通道轴，复数时之后还有实部/虚部轴
+            axes = tuple(i for i in range(real.ndim) if i != channel)
+            low = real.min(axis=axes, keepdims=True)
+            high = real.max(axis=axes, keepdims=True)
+            scale = np.where(high > low, (high - low) / (2 ** bits - 1), 1.0)
+            data = np.round((real - low) / scale).astype(np.uint8 if bits == 8 else np.uint16)
+            info = {'kind': 'quantized', 'scale': scale.ravel().tolist(), 'offset': low.ravel().tolist()}
+        else:
+            raise ValueError(f'unknown storage: {storage}')
+    data = np.ascontiguousarray(data, dtype=data.dtype.newbyteorder('<'))
+    info.update({'dtype': data.dtype.str, 'shape': list(data.shape)})
+    return data, info
+
+
+def decode(data, header):  # encode的逆过程，data可以是memmap的一部分（如一帧），返回原dtype的数组
+    storage = header['storage']
+    dtype = np.dtype(header['dtype'])
+    if storage['kind'] == 'raw':
+        return np.asarray(data)
+    real = np.asarray(data, dtype=np.float64)
+    if storage['kind'] == 'quantized':
+        channel = len(header['shape']) - 1 - (len(storage['shape']) - data.ndim)  # data为一帧时少了帧轴
+        shape = [1] * data.ndim
+        shape[channel] = -1
+        real = real * np.reshape(storage['scale'], shape) + np.reshape(storage['offset'], shape)
+    if np.issubdtype(dtype, np.complexfloating):
+        return (real[..., 0] + 1j * real[..., 1]).astype(dtype)
+    return real.astype(dtype)
+
+
+def write(path, cipher, encryptor=None, storage='raw', bits=16, nonces=None):
+    '''
+    把密文保存为容器文件
+    cipher: 一个密文，或shape为[N, H, W, C]的一组密文（如逐帧加密的视频）
+    encryptor: 加密时使用的加密器，用于在头部记录其注册的名称和加密操作
+    nonces: 逐帧加密时每帧使用的nonce，解密时会自动使用；个数需要与密文的帧数相同，一个密文时为一个nonce
+    '''
+    if nonces is not None:
+        nonces = [int(n) for n in nonces]
+        count = cipher.shape[0] if np.ndim(cipher) == 4 else 1
+        if len(nonces) != count:
+            raise ValueError(f'got {len(nonces)} nonces for {count} frame(s)')
+    data, info = encode(np.asarray(cipher), storage, bits)
+    header = {
+        'version': 1,
+        'shape': list(cipher.shape),
+        'dtype': np.dtype(cipher.dtype).str,
+        'encryptor': encryptor_registry.name_of(type(encryptor)) if encryptor is not None else None,
+        'operations': describe(encryptor) if encryptor is not None else None,
+        'nonces': nonces,
+        'storage': info,
+    }
+    text = json.dumps(header).encode()
+    header['offset'] = -(-(len(MAGIC) + LENGTH.size + len(text) + 64) // ALIGN) * ALIGN  # 为offset字段本身预留空间
+    text = json.dumps(header).encode()
+    with open(path, 'wb') as f:
+        f.write(MAGIC + LENGTH.pack(len(text)) + text)
+        f.write(b'\0' * (header['offset'] - f.tell()))
+        data.tofile(f)
+    return header
+
+
+class Container:  # 打开的容器文件，数据通过只读的np.memmap访问
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f'{path} is not a cipher container')
+            self.header = json.loads(f.read(LENGTH.unpack(f.read(LENGTH.size))[0]))
+        storage = self.header['storage']
+        self.data = np.memmap(path, dtype=np.dtype(storage['dtype']), mode='r', offset=self.header['offset'],
+                              shape=tuple(storage['shape']))
+
+    @property
+    def shape(self):
+        return tuple(self.header['shape'])
+
+    def is_batch(self):  # 是否为一组密文
+        return len(self.shape) == 4
+
+    def __len__(self):
+        return self.shape[0] if self.is_batch() else 1
+
+    def read(self):  # 读取全部密文
+        return decode(self.data, self.header)
+
+    def frames(self):  # 依次读取每一帧，每次只读入一帧
+        if not self.is_batch():
+            yield self.read()
+            return
+        for i in range(len(self)):
+            yield decode(self.data[i], self.header)
+
+    def check(self, encryptor):  # 检查加密器与头部中记录的是否一致
+        name = encryptor_registry.name_of(type(encryptor))
+        if self.header['encryptor'] is not None and name != self.header['encryptor']:
+            raise ValueError(f'container was written by {self.header["encryptor"]}, got {name}')
+        if self.header['operations'] is not None and strip(describe(encryptor)) != strip(self.header['operations']):
+            raise ValueError('encryptor operations do not match the container')
+
+    def decrypt_frames(self, encryptor, depth=2, reuse_buffers=False):  # 逐帧解密，边读边解密，返回生成器，reuse_buffers见encrypt_stream
+        self.check(encryptor)
+        return encryptor.decrypt_stream(self.frames(), nonces=self.header['nonces'], depth=depth, reuse_buffers=reuse_buffers)
+
+    def decrypt(self, encryptor):  # 解密全部密文
+        if not self.is_batch():
+            self.check(encryptor)
+            if self.header['nonces'] is not None:  # 使用nonce派生出的序列加密的单个密文
+                return encryptor.decrypt_with(self.read(), encryptor.sys.derive(self.header['nonces'][0]))
+            return encryptor.decrypt(self.read())
+        return np.stack([frame.copy() for frame in self.decrypt_frames(encryptor, reuse_buffers=True)])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='密文容器')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('info', help='显示容器的头部')
+    p.add_argument('path')
+    for command, help in (('encrypt', '加密图像并保存为容器'), ('decrypt', '解密容器并保存图像')):
+        p = sub.add_parser(command, help=help)
+        p.add_argument('src')
+        p.add_argument('dst')
+        p.add_argument('--encryptor', default='ClassicChaos', help='encryptor_registry中注册的加密器名称')
+        p.add_argument('--args', default='[]', help='加密器的位置参数，JSON列表')
+        p.add_argument('--kwargs', default='{}', help='加密器的关键字参数，JSON对象')
+        if command == 'encrypt':
+            p.add_argument('--storage', default='raw', choices=['raw', 'float16', 'quantized'])
+            p.add_argument('--bits', type=int, default=16, help='quantized时的位数，8或16')
+    opt = parser.parse_args()
+
+    if opt.command == 'info':
+        print(json.dumps(Container(opt.path).header, indent=2))
+    else:
+        en = encryptor_registry.build(opt.encryptor, *json.loads(opt.args), **json.loads(opt.kwargs))
+        if opt.command == 'encrypt':
+            write(opt.dst, en.encrypt(utils.read_array(opt.src)), en, opt.storage, opt.bits)
+        else:
+            rgb = Container(opt.src).decrypt(en)
+            print(f'saved to {utils.save_array(np.clip(np.round(np.real(rgb)), 0, 255).astype(np.uint8), opt.dst)}')
@@ -1,21 +1,21 @@
+import functools
 import numpy as np
-import random
 import sequence
 import utils
 from registry import encryptor_registry, operation_registry, chaos_mapping_registry, sequence_registry
-import trans
 import operation
-import evaluate
+import instrument
+import stream
 
-# 用该装饰器来记录加密/解密时间
+# 用该装饰器为加密/解密打开一个span，用于记录加密/解密时间，span的使用方法见instrument.py
+# 输入先转换为数组，因此encrypt_batch/decrypt_batch与基类一样也接受图像的列表
 def before_encrypt(encrypt=True):
     def decorator(func):
-        def wrapper(*args, **kwargs):
-            t = evaluate.Timer()  # 创建计时器
-            ret = func(*args, **kwargs)  # 执行加密/解密
-            cost = t.stop()  # 停止计时器
-            print(f'{args[0].__class__.__name__} took {cost} seconds to {"encrypt" if encrypt else "decrypt"}.')
-            return ret
+        @functools.wraps(func)
+        def wrapper(self, rgb, *args, **kwargs):
+            rgb = np.asarray(rgb)
+            with instrument.span(f'{self.__class__.__name__}.{"encrypt" if encrypt else "decrypt"}', rgb=rgb):
+                return func(self, rgb, *args, **kwargs)
         return wrapper
     return decorator
 
@@ -31,6 +31,82 @@ class BaseEncryptor:
     def decrypt(self, rgb):  # 执行解密
         pass
 
+    def encrypt_batch(self, rgbs):  # 对shape为[N, H, W, C]的一组图像加密，默认逐个加密
+        return np.stack([self.encrypt(rgb) for rgb in rgbs])
+
+    def decrypt_batch(self, rgbs):  # 对一组图像解密，默认逐个解密
+        return np.stack([self.decrypt(rgb) for rgb in rgbs])
+
+    def encrypt_stream(self, frames, decode=None, encode=None, nonces=None, depth=2, reuse_buffers=False):
+        '''
+        逐帧加密一个帧序列（视频、图像序列），返回按顺序生成每帧结果的生成器
+        frames: 可迭代的帧，decode不为None时每项先经过decode转换为图像
+        encode: 对每帧的加密结果调用，生成的是encode的返回值
+        nonces: 每帧的nonce（整数），如itertools.count()，第i帧使用self.sys.derive(nonces[i])派生出的序列，
+                使各帧不共用序列；为None时所有帧使用与encrypt相同的序列
+        depth: 流水线相邻两个阶段之间最多缓存的帧数
+        reuse_buffers: 为True时各帧的加密结果写入复用的缓冲区，减少内存分配，但没有encode时生成的数组只保证在
+                       取下一帧之前有效，需要保留时应自行复制；为False时每帧的结果都是新的数组
+        解码、加密、编码在各自的线程中同时执行，见stream.py
+        '''
+        return stream.pipeline(frames, [decode, *self.stream_stages(nonces, depth, reuse_buffers=reuse_buffers), encode], depth)
+
+    def decrypt_stream(self, frames, decode=None, encode=None, nonces=None, depth=2, reuse_buffers=False):  # 逐帧解密，nonces需要与加密时相同
+        stages = self.stream_stages(nonces, depth, reverse=True, reuse_buffers=reuse_buffers)
+        return stream.pipeline(frames, [decode, *stages, encode], depth)
+
+    def stream_stages(self, nonces, depth, reverse=False, reuse_buffers=False):  # 流水线中加密/解密的阶段，默认对每帧调用encrypt/decrypt
+        if nonces is not None:
+            raise ValueError(f'{self.__class__.__name__} does not support per-frame nonces')
+        return [self.decrypt if reverse else self.encrypt]
+
+
+# 猫脸变换的周期，即把(N, a, b)对应的变换矩阵连乘多少次后回到单位阵
+@functools.lru_cache(maxsize=64)
+def arnold_period(N, a, b):
+    m = ((1, b), (a, a * b + 1))  # 猫脸变换矩阵 [[1, b], [a, ab+1]]
+    p = (1 % N, b % N, a % N, (a * b + 1) % N)
+    period = 1
+    while p != (1 % N, 0, 0, 1 % N):  # 矩阵的阶不超过3N，直接迭代即可
+        p = ((p[0] * m[0][0] + p[1] * m[1][0]) % N, (p[0] * m[0][1] + p[1] * m[1][1]) % N,
+             (p[2] * m[0][0] + p[3] * m[1][0]) % N, (p[2] * m[0][1] + p[3] * m[1][1]) % N)
+        period += 1
+    return period
+
+
+# 下标的类型，N*N不超过int32的范围时使用int32，使下标的内存减半
+def index_dtype(N):
+    return np.int32 if N * N < 2**31 else np.intp
+
+
+# 单次猫脸变换对应的gather下标：result.flat[k] = rgb.flat[index[k]]
+# reverse为True时返回逆变换的下标。只在arnold_power_index中使用，不缓存
+def arnold_index(N, a, b, reverse=False):
+    x, y = np.divmod(np.arange(N * N, dtype=np.int64), N)  # 结果图像中的像素位置
+    if not reverse:  # 加密时(i, j)被移动到(x, y)，因此要用逆映射找到来源像素
+        i = ((a * b + 1) * x - b * y) % N
+        j = (-a * x + y) % N
+    else:  # 解密时来源像素由正向映射给出
+        i = (x + b * y) % N
+        j = (a * x + (a * b + 1) * y) % N
+    return (i * N + j).astype(index_dtype(N))
+
+
+# 执行times次猫脸变换对应的gather下标，利用周期缩减次数，再用快速幂在O(log times)次复合内得到
+# 结果按(N, a, b, 次数, 方向)缓存，加密和解密各占一项；N=4096时一项约67MB，因此只保留最近的4项
+@functools.lru_cache(maxsize=4)
+def arnold_power_index(N, a, b, times, reverse=False):
+    times %= arnold_period(N, a, b)
+    base = arnold_index(N, a, b, reverse)
+    result = np.arange(N * N, dtype=index_dtype(N))
+    while times > 0:
+        if times & 1:
+            result = result[base]  # 先做result再做base
+        base = base[base]
+        times >>= 1
+    result.setflags(write=False)
+    return result
+
 
 # 猫脸变换加密器
 @encryptor_registry.register('Arnold')
@@ -39,36 +115,94 @@ class ArnoldTransform(BaseEncryptor):
         self.a = a
         self.b = b
         self.shuffle_times = shuffle_times
-    
+
+    def transform(self, rgb, reverse=False):  # rgb的shape为[..., N, N, C]
+        N = rgb.shape[-3]
+        if rgb.shape[-3] != rgb.shape[-2]:
+            raise ValueError(f'Arnold only accepts images with same height and width, got {rgb.shape}')
+        # 所有像素的置位合并为一次gather操作，下标按(N, a, b, 次数)缓存
+        index = arnold_power_index(N, self.a, self.b, self.shuffle_times, reverse)
+        result = np.take(rgb.reshape(rgb.shape[:-3] + (N * N, -1)), index, axis=-2)
+        return result.reshape(rgb.shape).astype(np.uint8, copy=False)
+
     @before_encrypt(encrypt=True)
     def encrypt(self, rgb):
-        N = rgb.shape[0]
-        if rgb.shape[0] != rgb.shape[1]:
-            print('Arnold only accepts images with same height and width')
-            exit(-1)
-        result = np.zeros(shape=rgb.shape, dtype=np.uint8)
-        for _ in range(self.shuffle_times):
-            for i in range(N):
-                for j in range(N):  # 对图像的像素重新置位
-                    x = (i + self.b * j) % N
-                    y = (self.a * i + (self.a * self.b + 1) * j) % N
-                    result[x, y, :] = rgb[i, j, :]
-        return result
-    
+        return self.transform(rgb, reverse=False)
+
     @before_encrypt(encrypt=False)
     def decrypt(self, rgb):
-        N = rgb.shape[0]
-        if rgb.shape[0] != rgb.shape[1]:
-            print('Arnold only accepts images with same height and width')
-            exit(-1)
-        result = np.zeros(shape=rgb.shape, dtype=np.uint8)
-        for _ in range(self.shuffle_times):
-            for i in range(N):
-                for j in range(N):  # 逆向的置位
-                    x = ((self.a * self.b + 1) * i - self.b * j) % N
-                    y = (-self.a * i + j) % N
-                    result[x, y, :] = rgb[i, j, :]
-        return result
+        return self.transform(rgb, reverse=True)
+
+    @before_encrypt(encrypt=True)
+    def encrypt_batch(self, rgbs):  # 同一组图像共用一个下标，一次完成
+        return self.transform(rgbs, reverse=False)
+
+    @before_encrypt(encrypt=False)
+    def decrypt_batch(self, rgbs):
+        return self.transform(rgbs, reverse=True)
+
+
+# 编译后的加密计划，对应一个图像shape
+# 其中包含了加密所需的全部置换、扩散序列和变换，加密/解密时只需依次执行每个步骤，不再使用序列发生器
+# 计划创建后不再修改，可以被多个线程同时使用
+class EncryptionPlan:
+    def __init__(self, shape, steps):
+        self.shape = tuple(shape)  # 单个图像的shape，即[H, W, C]
+        self.steps = tuple(steps)
+        self.nbytes = sum(step.nbytes() for step in self.steps)  # 计划中保存的序列、下标等占用的字节数
+
+    def check(self, rgb):
+        if tuple(rgb.shape[-3:]) != self.shape:
+            raise ValueError(f'plan compiled for shape {self.shape}, got {rgb.shape}')
+
+    def encrypt(self, rgb):  # rgb可以是一个图像，也可以是shape为[N, H, W, C]的一组图像
+        self.check(rgb)
+        for step in self.steps:
+            with instrument.span(step.__class__.__name__, rgb=rgb):
+                rgb = step.forward(rgb)
+        return rgb
+
+    def decrypt(self, rgb):  # 倒序执行每个步骤的逆过程
+        self.check(rgb)
+        for step in reversed(self.steps):
+            with instrument.span(step.__class__.__name__, rgb=rgb):
+                rgb = step.backward(rgb)
+        return rgb
+
+    def passes(self):  # 加密一次大约遍历整个图像的次数
+        return sum(step.passes() for step in self.steps)
+
+    def run(self, rgb, reverse=False, scratch=None, output=None):
+        '''
+        与encrypt/decrypt相同，但中间结果写入scratch中的数组，最后一步的结果写入output中的数组，不再为每一步分配内存
+        scratch, output: BufferPool，用于逐帧加密时在各帧之间复用内存，output为None时最后一步的结果写入新的数组
+        '''
+        self.check(rgb)
+        steps = self.steps if not reverse else self.steps[::-1]
+        for i, step in enumerate(steps):
+            if i < len(steps) - 1:
+                out = scratch.get(rgb.shape, rgb.dtype, avoid=rgb)
+            else:
+                out = output.get(rgb.shape, rgb.dtype, avoid=rgb) if output is not None else np.empty(rgb.shape, rgb.dtype)
+            with instrument.span(step.__class__.__name__, rgb=rgb):
+                rgb = step.backward_into(rgb, out) if reverse else step.forward_into(rgb, out)
+        return rgb
+
+
+# 按shape和dtype缓存的一组数组，每次get依次轮流返回其中之一
+# 逐帧加密时用于复用各帧的中间结果与输出，count决定了一个数组被再次返回之前最多可以同时使用的数组个数
+class BufferPool:
+    def __init__(self, count=2):
+        self.count = count
+        self.arrays = {}  # (shape, dtype) -> [数组列表, 下一个返回的下标]
+
+    def get(self, shape, dtype, avoid=None):  # avoid为正在被读取的数组，不会被返回
+        entry = self.arrays.setdefault((tuple(shape), np.dtype(dtype)), [[np.empty(shape, dtype) for _ in range(self.count)], 0])
+        arrays, i = entry
+        if arrays[i] is avoid:
+            i = (i + 1) % self.count
+        entry[1] = (i + 1) % self.count
+        return arrays[i]
 
 
 # 基于序列发生器的加密器
@@ -76,41 +210,149 @@ class ArnoldTransform(BaseEncryptor):
 class BaseSequenceEncryptor(BaseEncryptor):
     # 序列发生器是指：每次调用序列发生器时，其能够提供一个数值，用于下一步的加密/解密操作
     # 目前实现的序列发生器包括：混沌系统、随机系统
+    max_plans = 16  # 最多缓存多少个shape的加密计划
+    max_plan_bytes = 256 * 2**20  # 缓存的加密计划最多占用的总字节数，为0时不缓存计划
+    fuse = True  # 编译时是否融合相邻的置换和扩散，见operation.fuse
+
     def __init__(self):
         super().__init__()
         self.sys = None  # 序列发生器，可以是混沌系统/随机数发生器
         self.ops = []  # 要执行的加密操作
         self.total_steps = 0  # 执行所有加密操作需要序列发生器提供的数值数目
+        self.plans = {}  # 按图像shape缓存的加密计划
     
     def add_chaos_map(self, map, initial):  # 添加混沌系统所使用的映射函数
         self.sys.add_mapping(map, inital=initial)
+        self.plans.clear()  # 序列改变后，已编译的计划失效
     
     def add_operation(self, op):  # 添加要执行的加密操作，这些加密操作会根据序列发生器给出的数值来进行加密
         if not isinstance(op, operation.BaseOperation):
             print(f'{op} not supported')
             return
         self.ops.append(op)
+        self.plans.clear()
         
+    def get_cost(self, rgb):  # 计算序列发生器需要为每个图像产生多少个数值
+        cost = 0
+        for op in self.ops:
+            cost += op.get_cost(rgb)
+        return cost
+
+    def compile(self, shape, sys=None, nonces=None):
+        '''
+        把所有加密操作编译为shape对应的加密计划
+        sys: 使用的序列发生器，默认为self.sys，序列总是从其初始状态开始生成
+        nonces: 为每个图像分别指定派生序列的nonce，此时计划用于shape为[len(nonces), H, W, C]的一组图像，
+                第i个图像使用sys.derive(nonces[i])派生出的序列
+        '''
+        sys = sys if sys is not None else self.sys
+        shape = tuple(shape[-3:])
+        cost = self.get_cost(np.broadcast_to(np.uint8(0), shape))
+        with instrument.span('keystream', cost=cost):
+            if nonces is None:
+                keys = sys.get_keystream(cost)
+            else:
+                keys = np.stack([sys.derive(nonce).get_keystream(cost) for nonce in nonces])
+        it = sequence.KeyStream(keys)
+        steps = []
+        for op in self.ops:
+            steps += op.compile(shape, it)
+        return EncryptionPlan(shape, operation.fuse(steps) if self.fuse else steps)
+
+    def get_plan(self, shape):  # 获取shape对应的加密计划，第一次使用时编译并缓存
+        shape = tuple(shape[-3:])
+        plan = self.plans.get(shape)
+        if plan is None:
+            plan = self.compile(shape)
+            self.cache_plan(shape, plan)
+        return plan
+
+    def cache_plan(self, shape, plan):
+        # 缓存的计划超过max_plans个或总字节数超过max_plan_bytes时丢弃最早编译的计划，单个计划超过max_plan_bytes时不缓存
+        if plan.nbytes > self.max_plan_bytes:
+            return
+        while self.plans and (len(self.plans) >= self.max_plans or
+                              sum(p.nbytes for p in self.plans.values()) + plan.nbytes > self.max_plan_bytes):
+            self.plans.pop(next(iter(self.plans)))
+        self.plans[shape] = plan
+
+    def use_plan(self, shape):
+        # 解密时是否使用加密计划：已经缓存，或者计划可以被缓存（计划中至少保存了全部序列，序列的长度是计划大小的下界）
+        # 否则逐个操作解密，反向序列只在检查点之间重新生成（见sequence.ReverseKeyStream），内存不随序列长度增长
+        shape = tuple(shape[-3:])
+        return shape in self.plans or self.get_cost(np.broadcast_to(np.uint8(0), shape)) <= self.max_plan_bytes
+
+    def decrypt_stepwise(self, rgb, sys=None):  # 不编译计划，用sys（默认为self.sys）的反向序列逐个操作解密
+        sys = sys if sys is not None else self.sys
+        return self.apply(rgb, sys.get_reverse_iterator(self.get_cost(rgb)), reverse=True)
+
+    def apply(self, rgb, it, reverse=False):  # 用序列it依次执行每个加密操作，reverse时倒序执行每个加密操作的逆过程
+        for op in (self.ops if not reverse else reversed(self.ops)):
+            with instrument.span(op.__class__.__name__, rgb=rgb, op=op):
+                rgb = op(rgb, it, reverse=reverse)
+        return rgb
+
+    def encrypt_with(self, rgb, sys):  # 用序列发生器sys加密，序列从sys的初始状态开始，与解密时使用的序列一致
+        return self.compile(rgb.shape, sys).encrypt(rgb)
+
+    def decrypt_with(self, rgb, sys):  # 用序列发生器sys解密
+        if self.get_cost(rgb) > self.max_plan_bytes:
+            return self.decrypt_stepwise(rgb, sys)
+        return self.compile(rgb.shape, sys).decrypt(rgb)
+
+    def stream_stages(self, nonces, depth, reverse=False, reuse_buffers=False):
+        # 有nonces时由单独的阶段为每帧派生序列并编译加密计划，与前后帧的加密同时执行；否则所有帧使用缓存的计划
+        # 加密阶段的中间结果写入复用的缓冲区；reuse_buffers时输出也写入复用的缓冲区，
+        # 输出的缓冲区个数保证一帧在被生成后、生成下一帧之前不会被覆盖
+        scratch, output = BufferPool(2), (BufferPool(2 * depth + 3) if reuse_buffers else None)
+        nonces = iter(nonces) if nonces is not None else None
+
+        def key(rgb):  # 各阶段都只有一个线程，帧按顺序经过，因此依次取出的nonce与帧一一对应
+            sys = self.sys
+            if nonces is not None:
+                nonce = next(nonces, None)
+                if nonce is None:
+                    raise ValueError('more frames than nonces')
+                sys = self.sys.derive(nonce)
+            if reverse and not self.use_plan(rgb.shape):  # 计划过大时逐个操作解密，见use_plan
+                return rgb, sys
+            return rgb, self.get_plan(rgb.shape) if nonces is None else self.compile(rgb.shape, sys)
+
+        def crypt(item):
+            rgb, plan = item
+            with instrument.span(f'{self.__class__.__name__}.{"decrypt" if reverse else "encrypt"}', rgb=rgb):
+                if not isinstance(plan, EncryptionPlan):
+                    return self.decrypt_stepwise(rgb, plan)
+                return plan.run(rgb, reverse, scratch, output)
+
+        return [key, crypt]
+
     @before_encrypt(encrypt=True)
-    def encrypt(self, rgb):  # 加密
-        result = rgb.copy()
-        for op in self.ops:  # 依次执行每个加密操作
-            result = op(result, self.sys, reverse=False)
-        return result
+    def encrypt(self, rgb):  # 加密，使用缓存的加密计划，不改变序列发生器的状态
+        return self.get_plan(rgb.shape).encrypt(rgb)
     
     @before_encrypt(encrypt=False)
-    def decrypt(self, rgb):  # 解密
-        result = rgb.copy()
-        self.total_steps = 0
-        for op in self.ops:  # 计算序列发生器需要产生多少个数值
-            self.total_steps += op.get_cost(rgb)
-        
-        #  获取逆向的操作数序列，因为解密操作要按照加密操作的倒序来执行
-        #  获取逆向操作数序列的方法是，先生成正向的序列，然后再反转
-        it = self.sys.get_reverse_iterator(self.total_steps)
-        for op in reversed(self.ops):  # 倒序执行每个加密操作的逆过程
-            result = op(result, it, reverse=True)
-        return result
+    def decrypt(self, rgb):  # 解密，计划过大时不编译计划，见use_plan
+        if not self.use_plan(rgb.shape):
+            return self.decrypt_stepwise(rgb)
+        return self.get_plan(rgb.shape).decrypt(rgb)
+
+    @before_encrypt(encrypt=True)
+    def encrypt_batch(self, rgbs, per_item=False):
+        '''
+        对shape为[N, H, W, C]的一组图像加密，所有操作沿batch轴一次完成
+        per_item为False时所有图像共用一个序列，即与encrypt对单个图像所用的序列相同
+        per_item为True时第i个图像使用self.sys.derive(i)派生出的序列
+        '''
+        plan = self.get_plan(rgbs.shape) if not per_item else self.compile(rgbs.shape, nonces=range(len(rgbs)))
+        return plan.encrypt(rgbs)
+
+    @before_encrypt(encrypt=False)
+    def decrypt_batch(self, rgbs, per_item=False):  # 对一组图像解密，per_item需要与加密时相同
+        if not per_item and not self.use_plan(rgbs.shape):
+            return self.decrypt_stepwise(rgbs)
+        plan = self.get_plan(rgbs.shape) if not per_item else self.compile(rgbs.shape, nonces=range(len(rgbs)))
+        return plan.decrypt(rgbs)
 
 
 # 基于混沌系统的加密器
@@ -1,6 +1,5 @@
 import numpy as np
 import time
-from skimage.metrics import structural_similarity as ssim
 from registry import metric_registry
 
 
@@ -18,13 +17,17 @@ class BaseMetric:
         pass
 
 
+# 以下指标都支持一组图像：输入的shape为[..., H, W, C]，沿最后三维计算，返回shape为[...]的结果（单个图像时为标量）
+# 两个输入的shape可以不同，只要能够广播，例如用一个密文与一组密文比较
+
+
 # 均方误差
 @metric_registry.register('MSE')
 class MeanSquaredErrorMetric(BaseMetric):
     def __call__(self, rgb1, rgb2):
         rgb1 = np.clip(rgb1, 0, 255).astype(np.uint8)
         rgb2 = np.clip(rgb2, 0, 255).astype(np.uint8)
-        return np.mean((rgb1 - rgb2) ** 2)
+        return np.mean((rgb1.astype(np.float64) - rgb2) ** 2)  # 在uint8上相减会溢出
     
 
 # 峰值信噪比
@@ -33,7 +36,7 @@ class PeakSignal2NoiseRatioMetric(BaseMetric):
     def __call__(self, rgb1, rgb2):
         rgb1 = np.clip(rgb1, 0, 255).astype(np.uint8)
         rgb2 = np.clip(rgb2, 0, 255).astype(np.uint8)
-        mse = np.mean((rgb1 - rgb2) ** 2)
+        mse = np.mean((rgb1.astype(np.float64) - rgb2) ** 2)
         max_pixel = 255.0
         psnr = 20 * np.log10(max_pixel / np.sqrt(mse))
         return psnr
@@ -47,7 +50,68 @@ class StructuralSimilarityIndexMetric(BaseMetric):
             raise ValueError("Input images must have the same dimensions.")
         rgb1 = np.clip(rgb1, 0, 255).astype(np.uint8)
         rgb2 = np.clip(rgb2, 0, 255).astype(np.uint8)
+        from skimage.metrics import structural_similarity as ssim  # scikit-image较重，只在计算SSIM时导入
         ssim_value = ssim(rgb1, rgb2, channel_axis=2)
         return ssim_value
 
 
+
+
+# 像素数变化率(Number of Pixels Change Rate)，两个密文中不同的像素所占的百分比
+# 理想的加密算法在明文只改变一个像素时，NPCR应接近99.61%
+@metric_registry.register('NPCR')
+class NumberOfPixelsChangeRateMetric(BaseMetric):
+    def __call__(self, rgb1, rgb2):
+        return np.mean(rgb1 != rgb2, axis=(-3, -2, -1)) * 100
+
+
+# 统一平均变化强度(Unified Average Changing Intensity)，两个密文对应像素差的绝对值的平均值占255的百分比
+# 理想值约为33.46%
+@metric_registry.register('UACI')
+class UnifiedAverageChangingIntensityMetric(BaseMetric):
+    def __call__(self, rgb1, rgb2):
+        diff = np.abs(np.asarray(rgb1, dtype=np.float64) - np.asarray(rgb2, dtype=np.float64))
+        return np.mean(diff, axis=(-3, -2, -1)) / 255 * 100
+
+
+# 信息熵，对每个通道的灰度直方图计算熵，再对所有通道取平均，uint8图像的理想值为8
+# 只需要一个图像，rgb2被忽略
+@metric_registry.register('Entropy')
+class EntropyMetric(BaseMetric):
+    def __call__(self, rgb1, rgb2=None):
+        rgb1 = np.clip(np.round(np.real(rgb1)), 0, 255).astype(np.int64) if rgb1.dtype != np.uint8 else rgb1
+        batch, (H, W, C) = rgb1.shape[:-3], rgb1.shape[-3:]
+        channels = np.moveaxis(rgb1, -1, -3).reshape(-1, H * W)  # 每行为一个图像的一个通道
+        offset = np.arange(len(channels))[:, None] * 256  # 所有通道的直方图用一次bincount完成
+        hist = np.bincount((channels + offset).ravel(), minlength=len(channels) * 256).reshape(-1, 256)
+        p = hist / (H * W)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            entropy = -np.sum(np.where(p > 0, p * np.log2(p), 0), axis=-1)
+        return entropy.reshape(batch + (C,)).mean(axis=-1)
+
+
+# 相邻像素相关性，计算所有水平/垂直/对角相邻像素对的皮尔逊相关系数，再对所有通道取平均
+# 明文图像通常接近1，理想的密文应接近0；只需要一个图像，rgb2被忽略
+@metric_registry.register('Correlation')
+class AdjacentCorrelationMetric(BaseMetric):
+    def __init__(self, direction='horizontal'):  # horizontal, vertical或diagonal
+        if direction not in ('horizontal', 'vertical', 'diagonal'):
+            raise ValueError(f'unknown direction: {direction}')
+        self.direction = direction
+
+    def pairs(self, rgb):
+        if self.direction == 'horizontal':
+            return rgb[..., :, :-1, :], rgb[..., :, 1:, :]
+        if self.direction == 'vertical':
+            return rgb[..., :-1, :, :], rgb[..., 1:, :, :]
+        return rgb[..., :-1, :-1, :], rgb[..., 1:, 1:, :]
+
+    def __call__(self, rgb1, rgb2=None):
+        x, y = self.pairs(np.real(rgb1).astype(np.float64))
+        x = x - x.mean(axis=(-3, -2), keepdims=True)
+        y = y - y.mean(axis=(-3, -2), keepdims=True)
+        cov = np.mean(x * y, axis=(-3, -2))
+        std = np.sqrt(np.mean(x * x, axis=(-3, -2)) * np.mean(y * y, axis=(-3, -2)))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            corr = np.where(std > 0, cov / std, 0.0)  # 常数通道的相关系数记为0
+        return corr.mean(axis=-1)
@@ -0,0 +1,154 @@
+import cProfile
+import json
+import pstats
+import threading
+import time
+import tracemalloc
+
+
+# 加密过程的性能记录
+# 加密器、组合操作的每一轮以及每个操作都会打开一个嵌套的span，记录耗时、处理的字节数、消耗的序列数值个数等
+# span结束后交给已注册的sink处理；没有注册sink时span是一个什么都不做的对象，几乎没有开销
+
+
+class BaseSink:  # 处理span记录的基类
+    def start(self, record):  # span开始时调用
+        pass
+
+    def finish(self, record):  # span结束时调用，record中包含耗时等信息
+        pass
+
+
+# 在内存中按span的路径汇总次数和耗时
+class AggregateSink(BaseSink):
+    def __init__(self):
+        self.stats = {}
+
+    def finish(self, record):
+        stat = self.stats.setdefault(record['path'], {'count': 0, 'seconds': 0.0, 'max': 0.0, 'bytes': 0, 'cost': 0})
+        stat['count'] += 1
+        stat['seconds'] += record['seconds']
+        stat['max'] = max(stat['max'], record['seconds'])
+        stat['bytes'] += record.get('bytes', 0)
+        stat['cost'] += record.get('cost', 0)
+
+    def report(self):  # 按路径排序的汇总文本
+        lines = []
+        for path, stat in sorted(self.stats.items()):
+            lines.append(f'{path}: {stat["count"]} calls, {stat["seconds"]:.6f}s total, {stat["max"]:.6f}s max, '
+                         f'{stat["bytes"]} bytes, {stat["cost"]} values')
+        return '\n'.join(lines)
+
+
+# 把每个span写为一行JSON
+class JsonLinesSink(BaseSink):
+    def __init__(self, file):
+        self.file = open(file, 'a') if isinstance(file, str) else file
+        self.lock = threading.Lock()
+
+    def finish(self, record):
+        line = json.dumps(record)
+        with self.lock:
+            self.file.write(line + '\n')
+
+
+# 在最外层的span中运行cProfile，用于查看Python层面的热点
+class ProfileSink(BaseSink):
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self, record):
+        if record['depth'] == 0:
+            self.profile.enable()
+
+    def finish(self, record):
+        if record['depth'] == 0:
+            self.profile.disable()
+
+    def stats(self):
+        return pstats.Stats(self.profile)
+
+
+class NullSpan:  # 没有注册sink时使用的span
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class Span:
+    def __init__(self, tracer, name, rgb, op, fields):
+        self.tracer = tracer
+        self.record = {'name': name, **fields}
+        if rgb is not None:
+            self.record['bytes'] = rgb.nbytes
+        if op is not None:
+            self.record['cost'] = op.get_cost(rgb)
+
+    def __enter__(self):
+        stack = self.tracer.stack()
+        self.record['path'] = '/'.join([s.record['name'] for s in stack] + [self.record['name']])
+        self.record['depth'] = len(stack)
+        stack.append(self)
+        self.memory = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+        for sink in self.tracer.sinks:
+            sink.start(self.record)
+        self.time = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.record['seconds'] = time.perf_counter() - self.time
+        if self.memory is not None:  # 只有在tracemalloc启用时才记录分配的内存
+            self.record['allocated'] = tracemalloc.get_traced_memory()[0] - self.memory
+        self.tracer.stack().pop()
+        for sink in self.tracer.sinks:
+            sink.finish(self.record)
+        return False
+
+
+class Tracer:
+    def __init__(self):
+        self.sinks = []
+        self.local = threading.local()  # 每个线程有各自的span栈
+
+    def stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def span(self, name, rgb=None, op=None, **fields):
+        '''
+        打开一个span
+        rgb: 该步骤处理的图像，记录其字节数
+        op: 该步骤执行的操作，记录其get_cost，即消耗的序列数值个数
+        '''
+        if not self.sinks:
+            return NULL_SPAN
+        return Span(self, name, rgb, op, fields)
+
+
+NULL_SPAN = NullSpan()
+tracer = Tracer()
+span = tracer.span
+
+
+def add_sink(sink):
+    tracer.sinks.append(sink)
+    return sink
+
+
+def remove_sink(sink):
+    tracer.sinks.remove(sink)
+
+
+class capture:  # 在with语句内临时注册sink
+    def __init__(self, sink):
+        self.sink = sink
+
+    def __enter__(self):
+        return add_sink(self.sink)
+
+    def __exit__(self, *exc):
+        remove_sink(self.sink)
+        return False
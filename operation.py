@@ -1,73 +1,372 @@
+import numpy as np
 from registry import operation_registry
-import utils
+import instrument
+import sequence
+
+class BaseStep:  # 编译后的加密步骤，其中已经包含了所需的全部序列数值，执行时不再需要序列发生器
+    def forward(self, rgb):  # 加密
+        pass
+
+    def backward(self, rgb):  # 解密
+        pass
+
+    def forward_into(self, rgb, out):
+        '''
+        加密并尽量把结果写入预先分配的out（shape和dtype与rgb相同，且不是rgb本身），返回结果
+        不能写入out的步骤（如改变dtype的变换）返回新的数组，默认实现即是如此
+        '''
+        return self.forward(rgb)
+
+    def backward_into(self, rgb, out):  # 解密，out的要求同forward_into
+        return self.backward(rgb)
+
+    def passes(self):  # 执行一次大约需要遍历整个图像多少次，用于衡量计划的内存访问量
+        return 1
+
+    def optimize(self):  # 返回等价的、优化后的步骤，包含子步骤的步骤在这里融合子步骤，见fuse
+        return self
+
+    def nbytes(self):  # 该步骤保存的数组（序列、下标等）占用的字节数，用于限制缓存的加密计划的总大小
+        return 0
+
+
+class PermutationStep(BaseStep):  # 沿axis轴（0为行，1为列）对每个通道做一次置换
+    def __init__(self, axis, permutation):
+        '''
+        permutation: shape为[..., 通道, size]，置换后的图像满足 result[i] = rgb[permutation[i]]
+        '''
+        self.axis = axis
+        self.permutation = permutation
+        self.index = self.to_index(permutation)
+        self.inverse = self.to_index(np.argsort(permutation, axis=-1))  # 逆置换
+
+    def to_index(self, permutation):  # 调整为可以沿axis广播的下标
+        index = np.expand_dims(np.swapaxes(permutation, -1, -2), -2 - self.axis)
+        index.setflags(write=False)
+        return index
+
+    def gather(self, rgb, index, out=None):
+        if self.axis == 0 and index.ndim == 3 and out is not None:
+            # 行置换且所有图像共用一个序列时，逐通道用np.take整行复制到out，比take_along_axis快约3倍
+            for c in range(rgb.shape[-1]):
+                np.take(rgb[..., c], index[:, 0, c], axis=-2, out=out[..., c], mode='clip')
+            return out
+        index = index.reshape((1,) * (rgb.ndim - index.ndim) + index.shape)  # 所有图像共用一个序列时，沿batch轴广播
+        return np.take_along_axis(rgb, index, axis=self.axis - 3)  # 所有通道的置换一次完成
+
+    def forward(self, rgb):
+        return self.gather(rgb, self.index, np.empty(rgb.shape, rgb.dtype) if self.axis == 0 else None)
+
+    def backward(self, rgb):
+        return self.gather(rgb, self.inverse, np.empty(rgb.shape, rgb.dtype) if self.axis == 0 else None)
+
+    def forward_into(self, rgb, out):
+        return self.gather(rgb, self.index, out)
+
+    def backward_into(self, rgb, out):
+        return self.gather(rgb, self.inverse, out)
+
+    def nbytes(self):  # index是permutation的视图，不重复计算
+        return self.permutation.nbytes + self.inverse.nbytes
+
+
+class DiffusionStep(BaseStep):  # 一轮像素扩散
+    # 正向扩散 c[i] = (c[i-1] + p[i] + k[i]) % 256 展开后即 c[i] = sum(p[0..i] + k[0..i]) % 256，是前缀和
+    # 逆向扩散 p[i] = (c[i] - c[i-1] - k[i]) % 256 只依赖相邻的两个密文像素，是差分
+    # 两者都可以对整个数组一次完成
+    # 只用于整型图像：浮点图像（变换域、小波子带）的取值范围不是[0, 256)，取模后不可逆，
+    # 不取模时每轮前缀和又会使数值按长度的幂次增长，超出float64的精度后同样不可逆，因此直接报错
+    def __init__(self, keys):
+        self.keys = keys  # 正向顺序的数值，shape为[..., 像素数]
+        self.keys.setflags(write=False)
+
+    def flatten(self, rgb):
+        # 整型图像直接在uint8上运算，uint8的溢出回绕正好就是模256，不需要额外的内存
+        if not np.issubdtype(rgb.dtype, np.integer):
+            raise TypeError(f'diffusion requires integer images, got {rgb.dtype}')
+        return rgb.reshape(rgb.shape[:-3] + (-1,)).astype(np.uint8)  # 把每个二维图像展平为一维像素序列
+
+    def forward(self, rgb):  # 前缀和
+        if rgb.dtype == np.uint8:
+            return self.forward_into(rgb, np.empty(rgb.shape, np.uint8))
+        flt = self.flatten(rgb)
+        flt += self.keys
+        np.cumsum(flt, axis=-1, dtype=np.uint8, out=flt)
+        return flt.astype(rgb.dtype).reshape(rgb.shape)  # 还原成二维图像
+
+    def backward(self, rgb):  # 差分
+        if rgb.dtype == np.uint8:
+            return self.backward_into(rgb, np.empty(rgb.shape, np.uint8))
+        flt = self.flatten(rgb)
+        flt = np.diff(flt, axis=-1, prepend=np.uint8(0))
+        flt -= self.keys
+        return flt.astype(rgb.dtype).reshape(rgb.shape)
+
+    def writable(self, rgb, out):  # uint8图像可以直接在连续的out上计算
+        return rgb.dtype == np.uint8 and out.dtype == np.uint8 and out.shape == rgb.shape and out.flags.c_contiguous
+
+    def forward_into(self, rgb, out):
+        if not self.writable(rgb, out):
+            return self.forward(rgb)
+        src, dst = rgb.reshape(rgb.shape[:-3] + (-1,)), out.reshape(out.shape[:-3] + (-1,))
+        np.add(src, self.keys, out=dst)
+        np.cumsum(dst, axis=-1, dtype=np.uint8, out=dst)
+        return out
+
+    def backward_into(self, rgb, out):
+        if not self.writable(rgb, out):
+            return self.backward(rgb)
+        src, dst = rgb.reshape(rgb.shape[:-3] + (-1,)), out.reshape(out.shape[:-3] + (-1,))
+        np.subtract(src[..., 1:], src[..., :-1], out=dst[..., 1:])
+        dst[..., 0] = src[..., 0]
+        dst -= self.keys
+        return out
+
+    def passes(self):  # 加上密钥与前缀和/差分各一次
+        return 2
+
+    def nbytes(self):
+        return self.keys.nbytes
+
+
+class TransformStep(BaseStep):  # 图像变换，直接调用变换的正/逆过程
+    def __init__(self, transform):
+        self.transform = transform
+
+    def forward(self, rgb):
+        return self.transform.forward(rgb)
+
+    def backward(self, rgb):
+        return self.transform.backward(rgb)
+
+
+class FusedPermutationStep(BaseStep):
+    # 多次行置换与列置换合成的一次置换
+    # 行置换与列置换可交换，任意顺序的行、列置换合成后总是 result[h, w, c] = rgb[rows[c, h], columns[c, w], c]
+    # 每个通道先按rows取行、再按columns取列，只保存每个通道的行、列置换，不保存整个图像大小的下标
+    def __init__(self, rows, columns):
+        self.rows = rows  # shape为[通道, H]
+        self.columns = columns  # shape为[通道, W]
+        self.inverse_rows = np.argsort(rows, axis=-1)  # 解密用的逆置换，创建时一并生成，使计划创建后不再修改
+        self.inverse_columns = np.argsort(columns, axis=-1)
+
+    @staticmethod
+    def gather(rgb, rows, columns, out=None):
+        out = out if out is not None else np.empty(rgb.shape, rgb.dtype)
+        for c in range(rgb.shape[-1]):
+            np.take(np.take(rgb[..., c], rows[c], axis=-2), columns[c], axis=-1, out=out[..., c])
+        return out
+
+    def forward(self, rgb):
+        return self.gather(rgb, self.rows, self.columns)
+
+    def backward(self, rgb):
+        return self.gather(rgb, self.inverse_rows, self.inverse_columns)
+
+    def forward_into(self, rgb, out):
+        return self.gather(rgb, self.rows, self.columns, out)
+
+    def backward_into(self, rgb, out):
+        return self.gather(rgb, self.inverse_rows, self.inverse_columns, out)
+
+    def nbytes(self):
+        return self.rows.nbytes + self.columns.nbytes + self.inverse_rows.nbytes + self.inverse_columns.nbytes
+
+
+class FusedDiffusionStep(BaseStep):
+    # 连续m轮扩散合成的一步
+    # 记C为前缀和，每轮 y = C(x + k)，由线性可得m轮后 y = C^m(p) + A，A为这m轮扩散作用在全0图像上的结果
+    # 因此加密只需一次加法和m次前缀和，解密只需一次减法和m次差分，而不是每轮都遍历两次
+    # 只对uint8图像成立（模256的运算是精确的），其他图像依次执行原来的每一轮
+    def __init__(self, steps):
+        self.steps = steps
+        offset = np.zeros(steps[0].keys.shape, np.uint8)
+        for step in steps:
+            offset += step.keys
+            np.cumsum(offset, axis=-1, dtype=np.uint8, out=offset)
+        offset.setflags(write=False)
+        self.offset = offset
+
+    def forward(self, rgb):
+        if rgb.dtype != np.uint8:
+            for step in self.steps:
+                rgb = step.forward(rgb)
+            return rgb
+        return self.forward_into(rgb, np.empty(rgb.shape, np.uint8))
+
+    def backward(self, rgb):
+        if rgb.dtype != np.uint8:
+            for step in reversed(self.steps):
+                rgb = step.backward(rgb)
+            return rgb
+        return self.backward_into(rgb, np.empty(rgb.shape, np.uint8))
+
+    def forward_into(self, rgb, out):
+        if not self.steps[0].writable(rgb, out):
+            return self.forward(rgb)
+        src, dst = rgb.reshape(rgb.shape[:-3] + (-1,)), out.reshape(out.shape[:-3] + (-1,))
+        np.cumsum(src, axis=-1, dtype=np.uint8, out=dst)
+        for _ in range(len(self.steps) - 1):
+            np.cumsum(dst, axis=-1, dtype=np.uint8, out=dst)
+        dst += self.offset
+        return out
+
+    def backward_into(self, rgb, out):
+        if not self.steps[0].writable(rgb, out):
+            return self.backward(rgb)
+        src = rgb.reshape(rgb.shape[:-3] + (-1,))
+        # 差分不能原地计算，在out与临时数组之间交替，最后一次差分写入out
+        buffers = [out.reshape(out.shape[:-3] + (-1,)), np.empty(src.shape, np.uint8)]
+        flt = buffers[len(self.steps) % 2]
+        np.subtract(src, self.offset, out=flt)
+        for i in range(len(self.steps)):
+            dst = buffers[(len(self.steps) - 1 - i) % 2]
+            np.subtract(flt[..., 1:], flt[..., :-1], out=dst[..., 1:])
+            dst[..., 0] = flt[..., 0]
+            flt = dst
+        return out
+
+    def passes(self):
+        return len(self.steps) + 1
+
+    def nbytes(self):
+        return self.offset.nbytes + sum(step.nbytes() for step in self.steps)
+
+
+def fuse_permutations(run):  # 把一串共用序列的行/列置换合成为一步，合成结果为恒等置换时返回None
+    maps = {}  # 轴 -> 合成后的置换，shape为[通道, size]
+    for step in run:
+        current = maps.get(step.axis)
+        # 先做current再做step：result[i] = rgb[current[step[i]]]
+        maps[step.axis] = step.permutation if current is None else np.take_along_axis(current, step.permutation, axis=-1)
+    maps = {axis: p for axis, p in maps.items() if not np.array_equal(p, np.broadcast_to(np.arange(p.shape[-1]), p.shape))}
+    if not maps:  # 互逆的置换相互抵消
+        return None
+    if len(maps) == 1:  # 只沿一个轴，仍然使用一次PermutationStep
+        axis, p = maps.popitem()
+        return PermutationStep(axis, p)
+    return FusedPermutationStep(maps[0], maps[1])
+
+
+def fuse(steps):
+    '''
+    返回与steps等价、但遍历图像次数更少的步骤列表，用于编译后的加密计划
+    - 包含子步骤的步骤（位平面、小波子带）先融合各自的子步骤
+    - 相邻的、所有图像共用序列的行/列置换合成为一次gather，合成为恒等置换的（互逆的置换）直接删除
+    - 相邻的多轮扩散合成为一步
+    '''
+    steps = [step.optimize() for step in steps]
+    result = []
+    i = 0
+    while i < len(steps):
+        step = steps[i]
+        j = i + 1
+        if isinstance(step, PermutationStep) and step.permutation.ndim == 2:
+            while j < len(steps) and isinstance(steps[j], PermutationStep) and steps[j].permutation.ndim == 2:
+                j += 1
+            fused = fuse_permutations(steps[i:j]) if j - i > 1 else step
+            if fused is not None:
+                result.append(fused)
+        elif isinstance(step, DiffusionStep):
+            while j < len(steps) and isinstance(steps[j], DiffusionStep) and steps[j].keys.shape == step.keys.shape:
+                j += 1
+            result.append(FusedDiffusionStep(steps[i:j]) if j - i > 1 else step)
+        else:
+            result.append(step)
+        i = j
+    return result
+
 
 class BaseOperation:  # 对图像（原始域或变换域）作加密操作的基类
     def __init__(self, times=1):
         self.times = times
 
-    def __call__(cls, rgb, it: iter, reverse=False):
+    def __call__(self, rgb, it: iter, reverse=False):
         '''
-        it: 序列发生器
-        reverse: 是否执行逆变换
+        rgb: shape为[H, W, C]的图像，或shape为[N, H, W, C]的一组图像
+        it: 序列发生器，通过it.take(n)批量获取n个离散化后的数值
+            对一组图像加密时，take可能返回shape为[N, n]的数组，即每个图像使用各自的序列
+        reverse: 是否执行逆变换，此时it是逆向的序列，take得到的数值也是逆序的
+        默认实现先用compile编译出加密步骤再执行
         '''
+        if not reverse:
+            for step in self.compile(rgb.shape, it):
+                rgb = step.forward(rgb)
+        else:  # 一次取出本操作所需的全部数值，翻转回正向的顺序后再编译，然后倒序执行每一步的逆过程
+            keys = it.take(self.get_cost(rgb))[..., ::-1]
+            for step in reversed(self.compile(rgb.shape, sequence.KeyStream(keys))):
+                rgb = step.backward(rgb)
+        return rgb
+
+    def get_cost(self, rgb):  # 该操作对每个图像需要从序列发生器获取多少个数值
         pass
 
-    def get_cost(cls, rgb):  # 该操作需要从序列发生器获取多少个数值
+    def describe(self):
+        '''
+        返回可以保存为JSON的描述：注册的名称、参数（只包含数值、字符串等简单类型）以及子操作
+        参数中不包含序列，即不包含密钥，可以和密文一起保存
+        '''
+        simple = (int, float, str, bool, type(None))
+        params = {key: list(value) if isinstance(value, tuple) else value for key, value in vars(self).items()
+                  if key != 'op_list' and (isinstance(value, simple) or
+                                           isinstance(value, (tuple, list)) and all(isinstance(v, simple) for v in value))}
+        result = {'name': operation_registry.name_of(type(self)), 'params': params}
+        if hasattr(self, 'op_list'):
+            result['ops'] = [op.describe() for op in self.op_list]
+        return result
+
+    def compile(self, shape, it):
+        '''
+        把该操作编译为一组加密步骤（BaseStep），按正向的顺序从it中取出所需的数值
+        shape: 图像的shape
+        '''
         pass
 
 
-@operation_registry.register('RowShuffle')
-class RowShuffleOperation(BaseOperation):  # 随机交换两行，执行times次
-    def __call__(self, rgb, it: iter, reverse=False):
-        for _ in range(self.times):  # 执行times次
-            for dim in (range(rgb.shape[2]) if not reverse else reversed(range(rgb.shape[2]))):  # 选择RGB三个通道之一
-                # next(it)将从序列发生器获得一个值，再用utils.discrete把序列发生器得到的数值离散化
-                x1 = utils.discrete(next(it)) % rgb.shape[0]  # 取模保证不越界
-                x2 = utils.discrete(next(it)) % rgb.shape[0]
-                rgb[[x1, x2], :, dim] = rgb[[x2, x1], :, dim]  # 交换两行
-        return rgb
+class BaseShuffleOperation(BaseOperation):  # 沿axis轴随机交换两行/两列，执行times次
+    axis = 0  # 0为行，1为列
+
+    def get_permutation(self, keys, size, channels):
+        '''
+        把times次交换合成为每个通道的一个置换，返回shape为[..., 通道, size]的数组
+        置换后的图像满足 result[i] = rgb[permutation[i]]
+        keys: 正向顺序的数值，每两个数值对应一次交换，shape为[..., n]
+        '''
+        batch = keys.shape[:-1]
+        swaps = keys.reshape(batch + (self.times, channels, 2)).astype(np.intp) % size  # 取模保证不越界
+        permutation = np.broadcast_to(np.arange(size), batch + (channels, size)).copy()
+        flat = permutation.reshape(-1, size)  # 每行对应一个图像的一个通道
+        rows = np.arange(len(flat))
+        for t in range(self.times):  # 每次交换同时作用在所有图像的所有通道上
+            x1, x2 = swaps[..., t, :, 0].reshape(-1), swaps[..., t, :, 1].reshape(-1)
+            flat[rows, x1], flat[rows, x2] = flat[rows, x2], flat[rows, x1]
+        return permutation
+
+    def compile(self, shape, it):  # 所有交换合成为一次置换
+        keys = it.take(2 * shape[-1] * self.times)
+        return [PermutationStep(self.axis, self.get_permutation(keys, shape[self.axis - 3], shape[-1]))]
 
     def get_cost(self, rgb):
-        return 2 * rgb.shape[2] * self.times
+        return 2 * rgb.shape[-1] * self.times
 
 
-@operation_registry.register('ColumnShuffle')
-class ColumnShuffleOperation(BaseOperation):  # 随机交换两列，执行times次。实现同RowShuffleOperation
-    def __call__(self, rgb, it: iter, reverse=False):
-        for _ in range(self.times):
-            for dim in (range(rgb.shape[2]) if not reverse else reversed(range(rgb.shape[2]))):
-                y1 = utils.discrete(next(it)) % rgb.shape[1]
-                y2 = utils.discrete(next(it)) % rgb.shape[1]
-                rgb[:, [y1, y2], dim] =rgb[:, [y2, y1], dim]
-        return rgb
+@operation_registry.register('RowShuffle')
+class RowShuffleOperation(BaseShuffleOperation):  # 随机交换两行，执行times次
+    axis = 0
 
-    def get_cost(self, rgb):
-        return 2 * rgb.shape[2] * self.times
+
+@operation_registry.register('ColumnShuffle')
+class ColumnShuffleOperation(BaseShuffleOperation):  # 随机交换两列，执行times次
+    axis = 1
 
 
 @operation_registry.register('Diffusion')
 class DiffusionOperation(BaseOperation):  # 像素扩散操作，把一个像素的信息扩散到图像的其他部分
-    def __call__(self, rgb, it: iter, reverse=False):
-        shape = rgb.shape
-        flt = rgb.flatten()  # 把二维图像展平为一维像素序列
-        for _ in range(self.times):
-            if not reverse:  # 执行正向扩散
-                for i in range(len(flt)):  # 考虑原图像中的每个像素
-                    if i == 0:  # 当前像素是图像中的第一个像素，该像素的信息将会被扩散到后面的所有像素
-                        flt[i] = (flt[i] + utils.discrete(next(it))) % 256
-                    else:  # 当前像素是中间的像素，其要接受前面像素扩散来的信息
-                        flt[i] = (flt[i - 1] + flt[i] + utils.discrete(next(it))) % 256
-            else:  # 逆向扩散，此时传入的it是已经逆向过的序列发生器
-                for i in reversed(range(len(flt))):  # 逆向遍历
-                    if i == 0:
-                        flt[i] = (flt[i] - utils.discrete(next(it))) % 256  # 从+变-
-                    else:
-                        flt[i] = (flt[i] - flt[i - 1] - utils.discrete(next(it))) % 256  # 从+变-
-        return flt.reshape(shape)  # 还原成二维图像
-    
+    def compile(self, shape, it):  # 每轮扩散取出与像素数相同的数值
+        return [DiffusionStep(it.take(shape[-3] * shape[-2] * shape[-1])) for _ in range(self.times)]
 
     def get_cost(self, rgb):
-        return rgb.shape[0] * rgb.shape[1] * rgb.shape[2] * self.times
+        return rgb.shape[-3] * rgb.shape[-2] * rgb.shape[-1] * self.times
 
 
 @operation_registry.register('Compositional')
@@ -77,13 +376,11 @@ class CompositionalChaosOperation(BaseOperation):  # 组合的加密操作，可
         self.times = times
 
     def __call__(self, rgb, it: iter, reverse=False):
-        for _ in range(self.times):
-            if not reverse:
-                for op in self.op_list:  # 依次执行所有的操作
-                    rgb = op(rgb, it, reverse)
-            else:
-                for op in reversed(self.op_list):
-                    rgb = op(rgb, it, reverse)
+        for i in range(self.times):
+            with instrument.span('round', round=i):
+                for op in (self.op_list if not reverse else reversed(self.op_list)):  # 依次执行所有的操作，逆向时倒序执行
+                    with instrument.span(op.__class__.__name__, rgb=rgb, op=op):
+                        rgb = op(rgb, it, reverse)
         return rgb
 
     def get_cost(self, rgb):  # 组合操作的cost是所有子操作的cost之和
@@ -91,3 +388,90 @@ class CompositionalChaosOperation(BaseOperation):  # 组合的加密操作，可
         for op in self.op_list:
             cnt += op.get_cost(rgb)
         return cnt * self.times
+
+    def compile(self, shape, it):  # 展开每一轮中的每个子操作
+        steps = []
+        for _ in range(self.times):
+            for op in self.op_list:
+                steps += op.compile(shape, it)
+        return steps
+
+
+class BitPlaneStep(BaseStep):  # 在选中的位平面上执行的加密步骤
+    def __init__(self, planes, steps):
+        self.planes = planes
+        self.steps = steps
+
+    def split(self, rgb):  # 取出选中的位平面，沿高度方向拼接后沿宽度方向每8位打包为一个字节
+        if rgb.dtype != np.uint8:
+            raise TypeError(f'bit plane operation requires uint8 images, got {rgb.dtype}')
+        w = rgb.shape[-2] - rgb.shape[-2] % 8  # 宽度不是8的整数倍时，右侧多出的列不参与
+        region = rgb[..., :w, :]
+        bits = np.concatenate([(region >> p) & 1 for p in self.planes], axis=-3)  # [..., k*H, w, C]
+        return np.packbits(bits, axis=-2), w  # [..., k*H, w/8, C]
+
+    def merge(self, rgb, packed, w):  # 把处理后的位平面写回，未选中的位平面保持不变
+        H = rgb.shape[-3]
+        bits = np.unpackbits(packed, axis=-2)
+        result = rgb.copy()
+        region = result[..., :w, :]
+        region &= np.uint8(~sum(1 << p for p in self.planes) & 0xFF)  # 清空选中的位平面
+        for i, p in enumerate(self.planes):
+            region |= bits[..., i * H:(i + 1) * H, :, :] << np.uint8(p)
+        return result
+
+    def forward(self, rgb):
+        packed, w = self.split(rgb)
+        for step in self.steps:
+            packed = step.forward(packed)
+        return self.merge(rgb, packed, w)
+
+    def backward(self, rgb):
+        packed, w = self.split(rgb)
+        for step in reversed(self.steps):
+            packed = step.backward(packed)
+        return self.merge(rgb, packed, w)
+
+    def passes(self):  # 拆分与写回，子步骤处理的数据量约为k/8
+        return 2 + sum(step.passes() for step in self.steps) * len(self.planes) / 8
+
+    def optimize(self):
+        return BitPlaneStep(self.planes, fuse(self.steps))
+
+    def nbytes(self):
+        return sum(step.nbytes() for step in self.steps)
+
+
+# 位平面选择性加密，只用于uint8图像
+# 取出planes中的位平面（7为最高位），沿高度方向拼接并按每8个像素打包为一个字节，得到shape为[..., k*H, W/8, C]的uint8数组，
+# 在其上执行op_list中的加密操作（置换、扩散），再拆开写回，其余位平面保持不变
+# 选中k个位平面时，所需的序列数值与处理的数据量约为全部加密时的k/8
+# 宽度不是8的整数倍时，右侧多出的列保持不变，宽度小于8时该操作不做任何改变
+@operation_registry.register('BitPlane')
+class BitPlaneOperation(BaseOperation):
+    def __init__(self, op_list, planes=(7, 6, 5, 4), times=1):
+        self.op_list = op_list
+        self.planes = tuple(planes)
+        self.times = times
+
+    def packed_shape(self, shape):  # 打包后的位平面数组的shape
+        return tuple(shape[:-3]) + (len(self.planes) * shape[-3], shape[-2] // 8, shape[-1])
+
+    def get_cost(self, rgb):
+        packed = np.broadcast_to(np.uint8(0), self.packed_shape(rgb.shape))
+        if packed.shape[-2] == 0:  # 宽度小于8时没有参与加密的列
+            return 0
+        cost = 0
+        for op in self.op_list:
+            cost += op.get_cost(packed)
+        return cost * self.times
+
+    def compile(self, shape, it):
+        packed = self.packed_shape(shape)
+        if packed[-2] == 0:  # 宽度小于8时整个图像保持不变
+            return []
+        steps = []
+        for _ in range(self.times):
+            for op in self.op_list:
+                steps += op.compile(packed, it)
+        return [BitPlaneStep(self.planes, steps)]
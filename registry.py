@@ -1,19 +1,48 @@
+import importlib
+
+
 class Registry:
     def __init__(self):
         self.registry = {}
+        self.declarations = {}  # 已声明但还没有导入的名称 -> 所在的模块
 
     def register(self, name):
         def decorator(cls):
             self.registry[name] = cls
             return cls
         return decorator
+
+    def declare(self, name, module):
+        # 声明name由module中的类注册，第一次使用name时才导入module
+        # 这样只用到部分加密器/操作时，不需要导入scipy、pywt、scikit-image等较重的依赖
+        self.declarations[name] = module
+
+    def names(self):  # 所有已注册和已声明的名称
+        return list(dict.fromkeys(list(self.registry) + list(self.declarations)))
+
+    def name_of(self, cls):  # cls注册时使用的名称，没有注册时返回类名
+        for name, registered in self.registry.items():
+            if registered is cls:
+                return name
+        return cls.__name__
     
     def get_class(self, name):
         cls = self.registry.get(name)
+        if cls is None and name in self.declarations:
+            importlib.import_module(self.declarations[name])  # 导入模块时其中的类会完成注册
+            cls = self.registry.get(name)
         if cls is None:
             raise ValueError(f'Unregistered Encryptor: {name}')
         return cls
 
+    def verify(self, base):  # 检查每个名称（包括声明的）都能导入并注册为base的子类，返回不符合的名称及其对应的类
+        wrong = {}
+        for name in self.names():
+            cls = self.get_class(name)
+            if not (isinstance(cls, type) and issubclass(cls, base)):
+                wrong[name] = cls
+        return wrong
+
     def build(self, name, *args, **kwargs):
         cls = self.get_class(name)
         return cls(*args, **kwargs)
@@ -25,3 +54,20 @@ chaos_mapping_registry = Registry()
 sequence_registry = Registry()
 attacker_registry = Registry()
 metric_registry = Registry()
+
+
+# 各名称所在的模块
+for name in ('Arnold', 'BaseSequence', 'BaseChaos', 'ClassicChaos', 'DiscreteCosineChaos', 'BaseRandom', 'ClassicRandom'):
+    encryptor_registry.declare(name, 'encrypt')
+for name in ('RowShuffle', 'ColumnShuffle', 'Diffusion', 'Compositional', 'BitPlane'):
+    operation_registry.declare(name, 'operation')
+for name in ('BlockDiscreteCosineTransform', 'RawDiscreteCosineTransform', 'DiscreteCosineTransform', 'FourierTransform', 'WaveletSubband'):
+    operation_registry.declare(name, 'trans')
+for name in ('Logistic', 'Tent', 'Arnold'):
+    chaos_mapping_registry.declare(name, 'sequence')
+for name in ('Chaos', 'Random'):
+    sequence_registry.declare(name, 'sequence')
+for name in ('PointReplace', 'RowErase', 'ColumnErase', 'BlockSwap'):
+    attacker_registry.declare(name, 'attack')
+for name in ('MSE', 'PSNR', 'SSIM', 'NPCR', 'UACI', 'Entropy', 'Correlation'):
+    metric_registry.declare(name, 'evaluate')
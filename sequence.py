@@ -1,8 +1,15 @@
+import hashlib
+import json
 import math
+import os
+from collections import OrderedDict
 import numpy as np
 import utils
-import random
 from registry import chaos_mapping_registry, sequence_registry
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 
 # 混沌映射基类
@@ -13,6 +20,18 @@ class BaseChaosMapping:
     def __len__(self):  # 该映射所需要的初值数量
         pass
 
+    def iterate(self, x, length):
+        '''
+        从状态x开始连续迭代length次
+        返回每一步状态的第一个值（即extract_element取出的值）组成的列表，以及迭代后的状态
+        子类可以重写该方法以避免逐次调用__call__的开销
+        '''
+        result = []
+        for _ in range(length):
+            x = self(x)
+            result.append(x[0] if isinstance(x, list) else x)
+        return result, x
+
 
 # Logistic映射
 @chaos_mapping_registry.register('Logistic')
@@ -26,6 +45,15 @@ class LogisticMapping(BaseChaosMapping):
     def __len__(self):
         return 1
 
+    def iterate(self, x, length):
+        mu = self.mu
+        result = []
+        append = result.append
+        for _ in range(length):
+            x = mu * x * (1 - x)
+            append(x)
+        return result, x
+
 
 # Tent映射
 @chaos_mapping_registry.register('Tent')
@@ -38,6 +66,15 @@ class TentMapping(BaseChaosMapping):
     
     def __len__(self):
         return 1
+
+    def iterate(self, x, length):
+        p = self.p
+        result = []
+        append = result.append
+        for _ in range(length):
+            x = x / p if 0 <= x < p else (1 - x) / (1 - p)
+            append(x)
+        return result, x
     
 
 # Arnold映射
@@ -59,6 +96,17 @@ class ArnoldMapping(BaseChaosMapping):
     def __len__(self):  # Arnold映射需要两个初值
         return 2
 
+    def iterate(self, v, length):
+        a, b, c = self.a, self.b, self.a * self.b + 1
+        modf = math.modf
+        x, y = v[0], v[1]
+        result = []
+        append = result.append
+        for _ in range(length):
+            x, y = modf(x + a * y)[0], modf(b * x + c * y)[0]
+            append(x)
+        return result, [x, y]
+
 
 # 序列发生器基类
 class BaseSequenceSystem:
@@ -78,6 +126,223 @@ class BaseSequenceSystem:
     def get_reverse_iterator(self, length):
         pass
 
+    # 从初始状态开始生成length个离散化后的数值，返回uint8数组，不影响当前状态
+    def get_keystream(self, length):
+        pass
+
+    # 获取接下来的n个数值，并离散化为uint8数组，加密操作通过该接口批量获取序列
+    # 子类可以重写该方法，默认实现逐个调用__next__
+    def take(self, n):
+        return np.fromiter((utils.discrete(next(self)) for _ in range(n)), dtype=np.uint8, count=n)
+
+    # 从状态status开始生成length个离散化后的数值，返回uint8数组以及生成后的状态，不影响当前状态
+    # 实现了该方法的序列发生器可以使用ReverseKeyStream作为反向迭代器
+    def generate(self, status, length):
+        pass
+
+    # 派生出一个相同配置、但初始状态由nonce决定的新序列发生器，用于让不同的图像使用各自的序列
+    def derive(self, nonce):
+        pass
+
+    # 从状态status开始跳过n个数值后的状态，默认实现直接生成这n个数值
+    # 可以直接跳转的序列发生器（如随机系统）可以重写该方法
+    def skip(self, status, n):
+        return self.generate(status, n)[1]
+
+    # 状态status在缓存中对应的键，需要包含序列发生器的参数，使不同配置的序列发生器可以共用一个缓存
+    def cache_key(self, status):
+        pass
+
+    # 带缓存地从状态status生成length个离散化后的数值，只返回序列，用于从初始状态生成整个序列
+    # cache默认为None，即不使用缓存；可以设置为内存中的KeystreamCache，或保存在磁盘上、可以被多个进程共用的KeystreamStore
+    cache = None
+
+    def cached_keystream(self, status, length):
+        if self.cache is None:
+            return self.generate(status, length)[0]
+        return self.cache.keystream(self, status, length)
+
+
+# 密钥流缓存，按最近最少使用(LRU)的顺序淘汰，总大小不超过max_bytes字节
+# 键由序列发生器的参数、起始状态（初值或随机种子）以及长度组成，值为uint8序列
+class KeystreamCache:
+    def __init__(self, max_bytes=256 * 2**20):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0  # 当前缓存的序列的总字节数
+        self.hits = 0
+        self.misses = 0
+
+    def keystream(self, system, status, length):  # 从缓存中获取序列，没有时由system生成并放入缓存
+        key = (system.cache_key(status), length)
+        keys = self.get(key)
+        if keys is None:
+            keys = system.generate(status, length)[0]
+            keys.setflags(write=False)  # 缓存的序列会被多次读取，不允许修改
+            self.put(key, keys)
+        return keys
+
+    def get(self, key):
+        keys = self.entries.get(key)
+        if keys is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return keys
+
+    def put(self, key, keys):
+        if keys.nbytes > self.max_bytes:  # 单个序列超过总大小，不缓存
+            return
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key).nbytes
+        self.entries[key] = keys
+        self.nbytes += keys.nbytes
+        while self.nbytes > self.max_bytes:  # 淘汰最久没有使用的序列
+            _, old = self.entries.popitem(last=False)
+            self.nbytes -= old.nbytes
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries), 'bytes': self.nbytes}
+
+
+# 保存在磁盘上的密钥流，可以被多个进程共用
+# 每个序列发生器配置及起始状态对应目录下的一组文件，文件名为键的sha256：
+#   .bin 离散化后的序列，只会在末尾追加；.json 元数据，记录已生成的长度及末尾的状态；.lock 写入时使用的文件锁
+# 读取时用np.memmap只读地映射.bin的前length字节，不复制数据；序列不够长时加锁，从末尾的状态继续生成并追加
+# 元数据先写入临时文件再用os.replace替换，读取者总是看到完整的元数据，且元数据中的长度对应的数据都已写入
+class KeystreamStore:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, name, suffix):
+        return os.path.join(self.directory, name + suffix)
+
+    def read_meta(self, name):
+        try:
+            with open(self.path(name, '.json')) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def write_meta(self, name, meta):  # 原子地替换元数据
+        temp = self.path(name, f'.json.{os.getpid()}.tmp')
+        with open(temp, 'w') as f:
+            json.dump(meta, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, self.path(name, '.json'))
+
+    def open(self, name, length):  # 只读地映射序列的前length个数值
+        if length == 0:
+            return np.empty(0, dtype=np.uint8)
+        return np.memmap(self.path(name, '.bin'), dtype=np.uint8, mode='r', shape=(length,))
+
+    def extend(self, system, key, name, status, length):  # 加锁后把序列追加到至少length个数值
+        with open(self.path(name, '.lock'), 'w') as lock:
+            if fcntl is not None:  # 没有fcntl的平台（Windows）上不加锁
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            meta = self.read_meta(name)  # 加锁后重新读取，其他进程可能已经生成了
+            if meta is None:
+                meta = {'key': key, 'length': 0, 'status': status}
+            if meta['length'] < length:
+                keys, end = system.generate(meta['status'], length - meta['length'])
+                with open(self.path(name, '.bin'), 'r+b' if meta['length'] else 'wb') as f:
+                    f.truncate(meta['length'])  # 丢弃之前的写入者中断时留下的、没有记录在元数据中的数据
+                    f.seek(meta['length'])
+                    f.write(keys.tobytes())
+                    f.flush()
+                    os.fsync(f.fileno())
+                meta = {'key': key, 'length': length, 'status': end}
+                self.write_meta(name, meta)
+
+    def keystream(self, system, status, length):
+        key = repr(system.cache_key(status))
+        name = hashlib.sha256(key.encode()).hexdigest()
+        meta = self.read_meta(name)
+        if meta is not None and meta['length'] >= length:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.extend(system, key, name, status, length)
+        return self.open(name, length)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+# 已离散化的序列，按顺序批量读取，它与序列发生器一样支持take
+class KeyStream:
+    def __init__(self, keys):
+        self.keys = keys
+        self.position = 0
+
+    def take(self, n):  # keys的shape可以为[..., length]，即一组图像各自的序列，沿最后一维读取
+        keys = self.keys[..., self.position:self.position + n]
+        if keys.shape[-1] < n:
+            raise StopIteration
+        self.position += n
+        return keys
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.take(1)[0]
+
+
+# 把多个序列组合在一起，take返回shape为[序列数, n]的数组，用于一组图像各自使用自己的序列
+class BatchKeyStream:
+    def __init__(self, streams):
+        self.streams = streams
+
+    def take(self, n):
+        return np.stack([stream.take(n) for stream in self.streams])
+
+
+# 反向读取序列发生器从status开始的前length个离散化数值
+# 只保存每一段起点的状态（检查点），读到某一段时再从检查点重新生成该段并翻转
+# 检查点和缓冲区都约为sqrt(length)大小，不需要把整个正向序列保存下来
+class ReverseKeyStream:
+    def __init__(self, system, status, length, segment=None):
+        self.system = system
+        self.length = length
+        self.segment = segment or max(math.isqrt(length), 1)  # 每一段的长度
+        self.checkpoints = []  # 每一段的起点及该起点处的状态
+        for start in range(0, length, self.segment):
+            self.checkpoints.append((start, status))
+            status = system.skip(status, min(self.segment, length - start))
+        self.buffer = np.empty(0, dtype=np.uint8)  # 当前段中还未读取的部分，已经翻转
+
+    def take(self, n):
+        if n == 0:  # 不需要数值的操作（如宽度小于8的位平面操作）
+            return np.empty(0, dtype=np.uint8)
+        blocks = []
+        while n > 0:
+            if len(self.buffer) == 0:  # 当前段读完了，从上一个检查点重新生成前一段
+                if not self.checkpoints:
+                    raise StopIteration
+                start, status = self.checkpoints.pop()
+                keys, _ = self.system.generate(status, min(self.segment, self.length - start))
+                self.buffer = keys[::-1]
+            block, self.buffer = self.buffer[:n], self.buffer[n:]
+            blocks.append(block)
+            n -= len(block)
+        return np.concatenate(blocks) if len(blocks) != 1 else blocks[0]
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.take(1)[0]
+
 
 # 混沌系统，继承自序列发生器基类
 @sequence_registry.register('Chaos')
@@ -86,6 +351,7 @@ class ChaosSystem(BaseSequenceSystem):
         self.map_list = []  # 混沌映射
         self.inital_value = []  # 混沌初值
         self.current_status = []  # 混沌状态
+        self.block_size = 1 << 16  # 批量生成时每块的长度，限制中间数组的内存
 
     def add_mapping(self, map: BaseChaosMapping, inital):  # 添加混沌映射
         if inital is list and len(inital) != len(map):
@@ -115,6 +381,45 @@ class ChaosSystem(BaseSequenceSystem):
         return result
 
 
+    def generate(self, status, length):
+        '''
+        从状态status开始，生成length个离散化后的混沌值
+        每个映射在自己的状态上连续迭代，按块离散化，避免逐步创建列表
+        返回uint8数组以及生成后的状态，不影响current_status
+        '''
+        status = status[:]
+        result = np.empty(length, dtype=np.uint8)
+        for start in range(0, length, self.block_size):
+            n = min(self.block_size, length - start)
+            block = np.empty((n, len(self.map_list)))
+            for (i, map) in enumerate(self.map_list):
+                block[:, i], status[i] = map.iterate(status[i], n)
+            result[start:start + n] = utils.discrete_array(block)
+        return result, status
+
+    def derive(self, nonce):  # 把nonce对应的偏移量加到每个初值上，再取小数部分
+        offset = math.modf((nonce + 1) * 0.6180339887498949)[0]
+        system = ChaosSystem()
+        system.block_size = self.block_size
+        system.cache = self.cache
+        for map, inital in zip(self.map_list, self.inital_value):
+            if isinstance(inital, list):
+                system.add_mapping(map, [(v + offset) % 1.0 for v in inital])
+            else:
+                system.add_mapping(map, (inital + offset) % 1.0)
+        return system
+
+    def cache_key(self, status):  # 混沌映射的类型与参数，以及各映射的状态
+        maps = tuple((map.__class__.__name__, tuple(sorted(vars(map).items()))) for map in self.map_list)
+        return maps, tuple(tuple(v) if isinstance(v, list) else v for v in status)
+
+    def get_keystream(self, length):  # 从initial_value开始生成length个离散化后的混沌值
+        return self.cached_keystream(self.inital_value, length)
+
+    def take(self, n):  # 从current_status开始生成n个离散化后的混沌值，并更新状态
+        result, self.current_status = self.generate(self.current_status, n)
+        return result
+
     def __next__(self):
         '''
         以current_status为当前状态，生成下一个混沌值，并更新状态
@@ -131,30 +436,85 @@ class ChaosSystem(BaseSequenceSystem):
 
     def get_reverse_iterator(self, length):  # 获取反向序列发生器
         self.reset()
-        seq = reversed(self.get_sequence(length))
-        return iter(seq)
+        if self.cache is not None:  # 启用缓存时直接使用缓存的整个序列
+            return KeyStream(self.get_keystream(length)[::-1])
+        return ReverseKeyStream(self, self.inital_value, length)
         
 
 # 随机系统，继承自序列发生器基类
 @sequence_registry.register('Random')
 class RandomSystem(BaseSequenceSystem):
-    def __init__(self, seed):
+    # 每个实例使用自己的numpy.random.Generator(PCG64)，不依赖全局的random模块，多个随机系统之间互不影响
+    # 序列的第i个数值对应PCG64的第i次输出，状态即为当前的位置，可以通过advance直接跳到任意位置
+    def __init__(self, seed, spawn_key=()):
         self.seed = seed
+        self.spawn_key = tuple(spawn_key)  # 派生序列发生器时附加的nonce
+        seed_sequence = np.random.SeedSequence(self.to_entropy(seed), spawn_key=self.spawn_key)
+        self.initial_state = np.random.PCG64(seed_sequence).state  # 位置0处的状态
+        self.position = 0  # 当前状态，即已经生成的数值个数
+        self.block_size = 1 << 16  # 批量生成时每块的长度，限制中间数组的内存
 
-    def get_sequence(self, length=100):
-        result = []
-        for _ in range(length):
-            result.append(random.randint(0, 2**15))
-        return result
+    @staticmethod
+    def to_entropy(seed):  # SeedSequence只接受非负整数，其他种子先做哈希
+        if isinstance(seed, int) and seed >= 0:
+            return seed
+        return int.from_bytes(hashlib.sha256(repr(seed).encode()).digest(), 'little')
+
+    def bit_generator(self, position):  # 位于position处的PCG64
+        bit_generator = np.random.PCG64()
+        bit_generator.state = self.initial_state
+        bit_generator.advance(position)
+        return bit_generator
+
+    def get_sequence(self, length=100):  # 从当前位置开始的length个[0, 1)之间的随机数，不影响当前状态
+        raw = self.bit_generator(self.position).random_raw(length)
+        return (raw >> np.uint64(11)) * 2.0**-53  # 与Generator.random相同的转换方式
     
     def reset(self):
-        random.seed(self.seed)
+        self.position = 0
+
+    def advance(self, n):  # 跳过接下来的n个数值
+        self.position += n
+
+    def skip(self, status, n):  # 跳过n个数值只需要移动位置，不需要生成
+        return status + n
 
     def get_reverse_iterator(self, length):
         self.reset()
-        seq = reversed(self.get_sequence(length))
-        return iter(seq)
+        if self.cache is not None:  # 启用缓存时直接使用缓存的整个序列
+            return KeyStream(self.get_keystream(length)[::-1])
+        return ReverseKeyStream(self, 0, length)
     
     def __next__(self):
-        return random.randint(0, 2**15)
-        
+        value = self.get_sequence(1)[0]
+        self.position += 1
+        return value
+
+    def take(self, n):
+        result, self.position = self.generate(self.position, n)
+        return result
+
+    def get_keystream(self, length):  # 从位置0开始生成length个离散化后的随机数
+        return self.cached_keystream(0, length)
+
+    def derive(self, nonce):  # 把nonce加入SeedSequence的spawn_key，派生出独立的随机序列
+        system = RandomSystem(self.seed, self.spawn_key + (nonce,))
+        system.block_size = self.block_size
+        system.cache = self.cache
+        return system
+
+    def cache_key(self, status):  # 种子、派生的nonce以及位置
+        return 'PCG64', self.to_entropy(self.seed), self.spawn_key, status
+
+    def generate(self, status, length):
+        '''
+        从位置status开始生成length个离散化后的随机数，返回uint8数组以及生成后的位置
+        离散化即discrete(x) = floor(256 * x) % 256，对[0, 1)之间的随机数正好是其64位原始输出的最高8位
+        '''
+        result = np.empty(length, dtype=np.uint8)
+        bit_generator = self.bit_generator(status)  # 连续生成，每块从上一块结束的位置继续
+        for start in range(0, length, self.block_size):
+            raw = bit_generator.random_raw(min(self.block_size, length - start))
+            np.right_shift(raw, np.uint64(56), out=raw)
+            result[start:start + len(raw)] = raw
+        return result, status + length
@@ -0,0 +1,380 @@
+import argparse
+import asyncio
+import json
+import queue
+import struct
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from registry import encryptor_registry
+
+
+# 加密服务
+# 通过Unix socket或TCP接收加密/解密请求，在线程池中执行，结果按请求的顺序返回
+# 每条消息的格式为：4字节大端序的头部长度 + JSON头部 + 8字节大端序的数据长度 + 数据
+# 请求头部：{"id": ..., "op": "encrypt" | "decrypt" | "stats", "encryptor": 名称, "args": [], "kwargs": {},
+#           "shape": [H, W, C], "dtype": "uint8"}，数据为图像的原始字节
+# 响应头部：成功时为 {"id": ..., "ok": true, "shape": ..., "dtype": ..., "seconds": ...}，数据为结果的原始字节
+#           失败时为 {"id": ..., "ok": false, "error": {"type": 异常类名, "message": 异常信息}}，没有数据
+
+HEADER = struct.Struct('>I')
+PAYLOAD = struct.Struct('>Q')
+MAX_HEADER = 1 << 20  # 头部长度上限，超过时视为协议错误
+MAX_PAYLOAD = 1 << 30  # 数据长度上限，在读取数据之前检查，避免一个连接让服务缓存任意多的数据
+
+
+class ProtocolError(Exception):  # 消息格式不合法
+    pass
+
+
+async def read_message(reader, max_payload=MAX_PAYLOAD):  # 读取一条消息，连接正常关闭时返回None
+    try:
+        size = HEADER.unpack(await reader.readexactly(HEADER.size))[0]
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise ProtocolError('connection closed inside a message')
+    if size > MAX_HEADER:
+        raise ProtocolError(f'header of {size} bytes exceeds {MAX_HEADER}')
+    try:
+        header = json.loads(await reader.readexactly(size))
+        length = PAYLOAD.unpack(await reader.readexactly(PAYLOAD.size))[0]
+        if length > max_payload:
+            raise ProtocolError(f'payload of {length} bytes exceeds {max_payload}')
+        payload = await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        raise ProtocolError('connection closed inside a message')
+    except ValueError as e:
+        raise ProtocolError(f'invalid header: {e}')
+    if not isinstance(header, dict):
+        raise ProtocolError('header must be a JSON object')
+    return header, payload
+
+
+def write_message(writer, header, payload=b''):
+    data = json.dumps(header).encode()
+    writer.write(HEADER.pack(len(data)) + data + PAYLOAD.pack(len(payload)))
+    if payload:
+        writer.write(payload)
+
+
+def error_header(id, e):  # 把异常转换为结构化的错误
+    return {'id': id, 'ok': False, 'error': {'type': e.__class__.__name__, 'message': str(e)}}
+
+
+def resolved(result):  # 已经完成的future，用于在响应队列中直接返回结果
+    future = asyncio.get_running_loop().create_future()
+    future.set_result(result)
+    return future
+
+
+# 预先创建的加密器，按配置（名称与参数）分组
+# 同一配置的加密器可以被多个请求轮流使用，避免每个请求都重新创建加密器和编译加密计划
+# 客户端请求的其他配置最多保留max_configs个，超过时丢弃最久没有使用的配置及其空闲的加密器
+class EncryptorPool:
+    def __init__(self, size=0, configs=(), max_configs=16):
+        '''
+        size: 每个配置预先创建的加密器个数
+        configs: 预先创建的配置，每项为(name, args, kwargs)，这些配置不会被丢弃
+        max_configs: 除configs外最多保留的配置数
+        '''
+        self.pools = OrderedDict()  # 按最近使用的顺序排列
+        self.max_configs = max_configs
+        self.lock = threading.Lock()  # acquire/release在工作线程中调用
+        self.pinned = {self.config_key(name, args, kwargs) for name, args, kwargs in configs}
+        for name, args, kwargs in configs:
+            pool = self.get_pool(self.config_key(name, args, kwargs))
+            for _ in range(size):
+                pool.put(encryptor_registry.build(name, *args, **kwargs))
+
+    @staticmethod
+    def config_key(name, args=(), kwargs=None):
+        return json.dumps([name, list(args), kwargs or {}], sort_keys=True)
+
+    def get_pool(self, key):  # 获取key对应的队列并标记为最近使用，需要时丢弃最久没有使用的配置
+        with self.lock:
+            pool = self.pools.setdefault(key, queue.SimpleQueue())
+            self.pools.move_to_end(key)
+            unpinned = [k for k in self.pools if k not in self.pinned]
+            for k in unpinned[:max(len(unpinned) - self.max_configs, 0)]:
+                del self.pools[k]
+            return pool
+
+    def acquire(self, name, args=(), kwargs=None):  # 取出一个空闲的加密器，没有时新建一个
+        key = self.config_key(name, args, kwargs)
+        with self.lock:
+            pool = self.pools.get(key)
+        if pool is not None:
+            try:
+                return key, pool.get_nowait()
+            except queue.Empty:
+                pass
+        return key, encryptor_registry.build(name, *args, **(kwargs or {}))
+
+    def release(self, key, encryptor):  # 用完后放回
+        self.get_pool(key).put(encryptor)
+
+    def stats(self):
+        with self.lock:
+            return {key: pool.qsize() for key, pool in self.pools.items()}
+
+
+class EncryptionServer:
+    def __init__(self, workers=4, max_pending=64, pool=None, window=1024, max_payload=MAX_PAYLOAD):
+        '''
+        workers: 执行加密/解密的线程数
+        max_pending: 所有连接中等待执行和正在执行的请求数上限，达到上限后暂停读取新的请求
+        window: 统计延迟分位数时使用的最近请求数
+        max_payload: 一个请求的数据长度上限（字节），超过时返回错误并关闭连接
+        '''
+        self.executor = ThreadPoolExecutor(workers)
+        self.max_pending = max_pending
+        self.max_payload = max_payload
+        self.slots = None  # 在事件循环中创建的信号量
+        self.pool = pool or EncryptorPool()
+        self.pending = 0  # 已接收但还没有执行完的请求数
+        self.running = 0  # 正在执行的请求数
+        self.completed = 0
+        self.failed = 0
+        self.connections = {}  # 当前的连接，writer -> 处理该连接的task
+        self.latencies = deque(maxlen=window)  # 从接收到请求到执行完成的耗时
+        self.lock = threading.Lock()  # 保护工作线程中修改的计数
+        self.server = None
+
+    def execute(self, header, payload):  # 在线程池中执行的加密/解密
+        key, en = self.pool.acquire(header['encryptor'], header.get('args', ()), header.get('kwargs'))
+        with self.lock:
+            self.running += 1
+        try:
+            rgb = np.frombuffer(payload, dtype=np.dtype(header.get('dtype', 'uint8'))).reshape(header['shape'])
+            result = en.decrypt(rgb) if header['op'] == 'decrypt' else en.encrypt(rgb)
+            return np.ascontiguousarray(result)
+        finally:
+            self.pool.release(key, en)
+            with self.lock:
+                self.running -= 1
+
+    async def process(self, header, payload, received):  # 处理一个请求，返回响应的头部和数据
+        id = header.get('id')
+        try:
+            op = header.get('op')
+            if op not in ('encrypt', 'decrypt'):
+                raise ValueError(f'unknown op: {op}')
+            if 'encryptor' not in header or 'shape' not in header:
+                raise ValueError('encryptor and shape are required')
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(self.executor, self.execute, header, payload)
+            seconds = time.perf_counter() - received
+            self.latencies.append(seconds)
+            self.completed += 1
+            return {'id': id, 'ok': True, 'shape': list(result.shape), 'dtype': result.dtype.str,
+                    'seconds': seconds}, result.tobytes()
+        except Exception as e:  # 加密器中的任何异常都作为错误返回，不影响服务
+            self.failed += 1
+            return error_header(id, e), b''
+        finally:
+            self.pending -= 1
+            self.slots.release()
+
+    async def handle(self, reader, writer):  # 处理一个连接
+        # 读取与写回分开执行，同一连接上的多个请求可以同时执行，响应按请求的顺序返回
+        self.connections[writer] = asyncio.current_task()
+        responses = asyncio.Queue()
+
+        async def respond():
+            while True:
+                task = await responses.get()
+                if task is None:
+                    break
+                write_message(writer, *(await task))
+                await writer.drain()
+
+        responder = asyncio.create_task(respond())
+        try:
+            while True:
+                try:
+                    message = await read_message(reader, self.max_payload)
+                except ProtocolError as e:
+                    self.failed += 1
+                    await responses.put(resolved((error_header(None, e), b'')))  # 返回错误后关闭连接
+                    break
+                except ConnectionError:
+                    break
+                if message is None:
+                    break
+                if message[0].get('op') == 'stats':  # 统计信息直接返回，不占用队列
+                    await responses.put(resolved(({'id': message[0].get('id'), 'ok': True, 'stats': self.stats()}, b'')))
+                    continue
+                # 队列已满时等待空位，在此期间不再读取该连接上的请求，由socket的缓冲区向客户端施加背压
+                await self.slots.acquire()
+                self.pending += 1
+                await responses.put(asyncio.create_task(self.process(*message, time.perf_counter())))
+        finally:
+            await responses.put(None)
+            try:
+                await responder
+            except ConnectionError:
+                pass
+            self.connections.pop(writer, None)
+            writer.close()
+
+    def stats(self):
+        latencies = np.array(self.latencies)
+        percentile = lambda q: float(np.percentile(latencies, q)) if len(latencies) else 0.0
+        return {
+            'queue_depth': self.pending - self.running,  # 等待执行的请求数
+            'running': self.running,
+            'completed': self.completed,
+            'failed': self.failed,
+            'connections': len(self.connections),
+            'latency': {'p50': percentile(50), 'p90': percentile(90), 'p99': percentile(99)},
+            'idle_encryptors': self.pool.stats(),
+        }
+
+    async def start(self, path=None, host='127.0.0.1', port=0):  # path不为None时监听Unix socket，否则监听TCP
+        self.slots = asyncio.Semaphore(self.max_pending)
+        if path is not None:
+            self.server = await asyncio.start_unix_server(self.handle, path)
+        else:
+            self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server
+
+    async def close(self):  # 停止监听并关闭所有连接
+        self.server.close()
+        tasks = list(self.connections.values())
+        for writer in list(self.connections):
+            writer.close()
+        await asyncio.gather(*tasks, return_exceptions=True)  # 等待所有连接处理完毕
+        await self.server.wait_closed()
+        self.executor.shutdown()
+
+
+# 客户端，同一连接上的请求依次发送、依次读取响应
+class Client:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.count = 0
+
+    @classmethod
+    async def connect(cls, path=None, host='127.0.0.1', port=None):
+        if path is not None:
+            return cls(*await asyncio.open_unix_connection(path))
+        return cls(*await asyncio.open_connection(host, port))
+
+    async def request(self, header, payload=b''):  # 返回响应的头部和数据
+        self.count += 1
+        write_message(self.writer, {'id': self.count, **header}, payload)
+        await self.writer.drain()
+        message = await read_message(self.reader)
+        if message is None:
+            raise ConnectionError('server closed the connection')
+        return message
+
+    async def call(self, op, rgb, encryptor, args=(), kwargs=None):  # 返回结果数组，失败时抛出RuntimeError
+        rgb = np.ascontiguousarray(rgb)
+        header, payload = await self.request({'op': op, 'encryptor': encryptor, 'args': list(args), 'kwargs': kwargs or {},
+                                              'shape': list(rgb.shape), 'dtype': rgb.dtype.str}, rgb.tobytes())
+        if not header['ok']:
+            raise RuntimeError(f'{header["error"]["type"]}: {header["error"]["message"]}')
+        return np.frombuffer(payload, dtype=np.dtype(header['dtype'])).reshape(header['shape'])
+
+    async def encrypt(self, rgb, encryptor, args=(), kwargs=None):
+        return await self.call('encrypt', rgb, encryptor, args, kwargs)
+
+    async def decrypt(self, rgb, encryptor, args=(), kwargs=None):
+        return await self.call('decrypt', rgb, encryptor, args, kwargs)
+
+    async def stats(self):
+        return (await self.request({'op': 'stats'}))[0]['stats']
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+
+
+async def serve(path=None, host='127.0.0.1', port=8765, workers=4, max_pending=64, pool=None, max_payload=MAX_PAYLOAD):
+    server = EncryptionServer(workers, max_pending, pool, max_payload=max_payload)
+    await server.start(path, host, port)
+    print(f'listening on {path or f"{host}:{port}"}')
+    try:
+        await server.server.serve_forever()
+    finally:
+        await server.close()
+
+
+
+def expect(condition, message):  # 自检中的检查，不满足时抛出AssertionError
+    if not condition:
+        raise AssertionError(message)
+
+
+async def self_test(encryptor='ClassicRandom', args=(2024,), workers=2):
+    '''
+    在本地TCP端口上启动服务并检查：加密/解密往返、加密器的错误、超过上限的数据长度、统计信息以及配置个数的上限
+    全部通过时返回统计信息，否则抛出AssertionError
+    '''
+    pool = EncryptorPool(1, [(encryptor, list(args), {})], max_configs=2)
+    server = EncryptionServer(workers, max_pending=4, pool=pool, max_payload=1 << 20)
+    await server.start(port=0)
+    port = server.server.sockets[0].getsockname()[1]
+    try:
+        client = await Client.connect(port=port)
+        rgb = np.random.default_rng(0).integers(0, 256, (32, 32, 3), dtype=np.uint8)
+        cipher = await client.encrypt(rgb, encryptor, args)
+        expect(not np.array_equal(cipher, rgb), 'cipher equals the plain image')
+        expect(np.array_equal(await client.decrypt(cipher, encryptor, args), rgb), 'decrypt does not invert encrypt')
+
+        try:
+            await client.encrypt(rgb, 'NoSuchEncryptor')
+            expect(False, 'unknown encryptor did not fail')
+        except RuntimeError as e:
+            expect('ValueError' in str(e), f'unexpected error: {e}')
+
+        for seed in range(4):  # 每个种子是一个新的配置，只保留最近的max_configs个
+            await client.encrypt(rgb, encryptor, [seed])
+        stats = await client.stats()
+        expect(stats['completed'] == 6 and stats['failed'] == 1, f'unexpected counts: {stats}')
+        expect(len(stats['idle_encryptors']) == 1 + pool.max_configs, f'configs not bounded: {stats["idle_encryptors"]}')
+        await client.close()
+
+        client = await Client.connect(port=port)  # 数据长度超过上限时，在读取数据之前返回错误并关闭连接
+        data = json.dumps({'id': 1, 'op': 'encrypt'}).encode()
+        client.writer.write(HEADER.pack(len(data)) + data + PAYLOAD.pack(server.max_payload + 1))
+        await client.writer.drain()
+        header, _ = await read_message(client.reader)
+        expect(not header['ok'] and header['error']['type'] == 'ProtocolError', f'oversized payload accepted: {header}')
+        expect(await read_message(client.reader) is None, 'connection kept open after a protocol error')
+        await client.close()
+        return server.stats()
+    finally:
+        await server.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='加密服务')
+    parser.add_argument('--unix', default=None, help='Unix socket路径，指定时不监听TCP')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--workers', type=int, default=4, help='执行加密的线程数')
+    parser.add_argument('--max-pending', type=int, default=64, help='等待执行的请求数上限')
+    parser.add_argument('--encryptor', default=None, help='预先创建的加密器名称')
+    parser.add_argument('--args', default='[]', help='加密器的位置参数，JSON列表')
+    parser.add_argument('--kwargs', default='{}', help='加密器的关键字参数，JSON对象')
+    parser.add_argument('--pool-size', type=int, default=None, help='预先创建的加密器个数，默认与线程数相同')
+    parser.add_argument('--max-configs', type=int, default=16, help='客户端请求的其他配置最多保留的个数')
+    parser.add_argument('--max-payload', type=int, default=MAX_PAYLOAD, help='一个请求的数据长度上限（字节）')
+    parser.add_argument('--self-test', action='store_true', help='在本地端口上启动服务并检查各项功能，然后退出')
+    opt = parser.parse_args()
+    if opt.self_test:
+        print(json.dumps(asyncio.run(self_test(workers=opt.workers)), indent=2))
+        print('self test passed')
+        raise SystemExit
+    configs = [(opt.encryptor, json.loads(opt.args), json.loads(opt.kwargs))] if opt.encryptor else []
+    pool = EncryptorPool(opt.pool_size if opt.pool_size is not None else opt.workers, configs, opt.max_configs)
+    try:
+        asyncio.run(serve(opt.unix, opt.host, opt.port, opt.workers, opt.max_pending, pool, opt.max_payload))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,89 @@
+import queue
+import threading
+
+
+# 逐帧处理的线程流水线
+# 每个阶段在各自的线程中依次处理每一项，相邻两个阶段之间用有界队列连接，因此解码、加密、编码可以同时处理不同的帧
+# numpy、PIL等在处理大数组时会释放GIL，各阶段可以真正并行执行
+
+END = object()  # 输入结束的标记
+
+
+class StageError:  # 某个阶段抛出的异常，沿流水线传递到生成器中再抛出
+    def __init__(self, error):
+        self.error = error
+
+
+def put(q, item, stop):  # 放入队列，流水线被关闭时放弃并返回False
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def get(q, stop):  # 从队列取出，流水线被关闭时返回END
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return END
+
+
+def feed(items, q, stop):  # 读取输入的线程
+    try:
+        for item in items:
+            if not put(q, item, stop):
+                return
+    except Exception as e:
+        put(q, StageError(e), stop)
+        return
+    put(q, END, stop)
+
+
+def work(func, source, target, stop):  # 一个阶段的线程，对每一项调用func
+    while True:
+        item = get(source, stop)
+        if item is not END and not isinstance(item, StageError):
+            try:
+                item = func(item)
+            except Exception as e:
+                item = StageError(e)
+        if not put(target, item, stop) or item is END or isinstance(item, StageError):
+            return
+
+
+def pipeline(items, stages, depth=2):
+    '''
+    用流水线依次处理items中的每一项，返回按输入顺序生成最后一个阶段结果的生成器
+    stages: 每个阶段为一个函数，为None的阶段被跳过
+    depth: 相邻两个阶段之间最多缓存的项数
+    任一阶段抛出的异常在生成器中重新抛出，此后流水线停止；提前关闭生成器时所有线程随之退出
+    '''
+    stages = [func for func in stages if func is not None]
+    stop = threading.Event()
+    queues = [queue.Queue(depth) for _ in range(len(stages) + 1)]
+    threads = [threading.Thread(target=feed, args=(items, queues[0], stop), daemon=True)]
+    threads += [threading.Thread(target=work, args=(func, queues[i], queues[i + 1], stop), daemon=True)
+                for i, func in enumerate(stages)]
+
+    def generate():
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                item = queues[-1].get()
+                if item is END:
+                    return
+                if isinstance(item, StageError):
+                    raise item.error
+                yield item
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+    return generate()
@@ -0,0 +1,113 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import utils
+from registry import encryptor_registry, attacker_registry, metric_registry
+
+
+# 抗攻击能力测试
+# 对 加密器 x 攻击类型 x 攻击强度 组成的网格，分别加密、攻击密文、解密，再用metric_registry中的指标与原图比较
+# 网格中的每一项作为一个任务交给进程池，每个工作进程对每个加密器只创建一次并只加密一次原图
+# 攻击强度即攻击的次数(times)，每一项重复repeats次，使用不同的随机种子，取平均值
+
+ATTACK_ARGS = {  # 构建攻击器时除times和seed以外的参数
+    'BlockSwap': {'block_size': 8},
+}
+
+worker_rgb = None  # 工作进程中的原图
+worker_encryptors = {}  # 工作进程中的加密器及其密文，按加密器的编号缓存
+
+
+def init_worker(rgb):
+    global worker_rgb
+    worker_rgb = rgb
+
+
+def parse_encryptor(text):  # 解析 "名称" 或 "名称:JSON参数列表"，如 ClassicRandom:[2024]
+    name, _, args = text.partition(':')
+    return name, json.loads(args) if args else [], {}
+
+
+def get_encryptor(index, spec):
+    if index not in worker_encryptors:
+        name, args, kwargs = spec
+        en = encryptor_registry.build(name, *args, **kwargs)
+        worker_encryptors[index] = (en, en.encrypt(worker_rgb))
+    return worker_encryptors[index]
+
+
+def run_task(index, spec, attack_name, intensity, metrics, repeats, seed):  # 在工作进程中执行网格中的一项
+    en, cipher = get_encryptor(index, spec)
+    scores = {metric: [] for metric in metrics}
+    for r in range(repeats):
+        attacker = attacker_registry.build(attack_name, times=intensity, seed=(seed, index, intensity, r),
+                                           **ATTACK_ARGS.get(attack_name, {}))
+        decrypted = en.decrypt(attacker(cipher))
+        decrypted = np.clip(np.round(np.real(decrypted)), 0, 255).astype(np.uint8)
+        for metric in metrics:
+            scores[metric].append(float(metric_registry.build(metric)(worker_rgb, decrypted)))
+    return {metric: float(np.mean(values)) for metric, values in scores.items()}
+
+
+def sweep(rgb, encryptors, attacks=('RowErase', 'ColumnErase', 'PointReplace', 'BlockSwap'),
+          intensities=(0, 1, 5, 10, 20, 50), metrics=('MSE', 'PSNR', 'SSIM'), repeats=3, workers=None, seed=0):
+    '''
+    执行整个网格，返回每一项的结果
+    encryptors: 每项为(name, args, kwargs)
+    '''
+    t = time.perf_counter()
+    tasks = [(i, spec, name, intensity) for i, spec in enumerate(encryptors) for name in attacks for intensity in intensities]
+    with ProcessPoolExecutor(workers or os.cpu_count(), initializer=init_worker, initargs=(rgb,)) as pool:
+        futures = [pool.submit(run_task, i, spec, name, intensity, tuple(metrics), repeats, seed)
+                   for i, spec, name, intensity in tasks]
+        rows = []
+        for (i, spec, name, intensity), future in zip(tasks, futures):
+            row = {'encryptor': spec[0], 'args': spec[1], 'attack': name, 'intensity': intensity}
+            try:
+                row.update(future.result())
+            except Exception as e:  # 不支持该图像的加密器记录错误后继续
+                row['error'] = f'{e.__class__.__name__}: {e}'
+            rows.append(row)
+    return {'metrics': list(metrics), 'intensities': list(intensities), 'repeats': repeats,
+            'seconds': time.perf_counter() - t, 'rows': rows}
+
+
+def format_curves(report):  # 每个指标一张表，每行为一个加密器与攻击类型，每列为一个攻击强度
+    lines = []
+    for metric in report['metrics']:
+        lines.append(f'[{metric}]')
+        lines.append(f'{"encryptor":28s} {"attack":14s}' + ''.join(f'{i:>10}' for i in report['intensities']))
+        curves = {}
+        for row in report['rows']:
+            curves.setdefault((row['encryptor'], json.dumps(row['args']), row['attack']), {})[row['intensity']] = row.get(metric)
+        for (name, args, attack_name), curve in curves.items():
+            label = name if args == '[]' else f'{name}:{args}'
+            values = ''.join(f'{curve[i]:10.4f}' if curve.get(i) is not None else f'{"error":>10}'
+                             for i in report['intensities'])
+            lines.append(f'{label:28s} {attack_name:14s}{values}')
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='抗攻击能力测试')
+    parser.add_argument('image', help='原图，图像文件或.npy')
+    parser.add_argument('--encryptors', nargs='+', default=['ClassicChaos', 'ClassicRandom:[2024]'],
+                        help='加密器，格式为 名称 或 名称:JSON参数列表')
+    parser.add_argument('--attacks', nargs='+', default=['RowErase', 'ColumnErase', 'PointReplace', 'BlockSwap'])
+    parser.add_argument('--intensities', type=int, nargs='+', default=[0, 1, 5, 10, 20, 50], help='攻击次数')
+    parser.add_argument('--metrics', nargs='+', default=['MSE', 'PSNR', 'SSIM'])
+    parser.add_argument('--repeats', type=int, default=3, help='每一项使用不同随机种子重复的次数')
+    parser.add_argument('--workers', type=int, default=None, help='工作进程数，默认为CPU核数')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='保存结果的JSON文件')
+    opt = parser.parse_args()
+    report = sweep(utils.read_array(opt.image), [parse_encryptor(e) for e in opt.encryptors], opt.attacks,
+                   opt.intensities, opt.metrics, opt.repeats, opt.workers, opt.seed)
+    print(format_curves(report))
+    print(f'{len(report["rows"])} runs, {report["seconds"]:.2f}s')
+    if opt.output:
+        with open(opt.output, 'w') as f:
+            json.dump(report, f, indent=2)
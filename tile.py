@@ -0,0 +1,78 @@
+import argparse
+import json
+import numpy as np
+import encrypt
+from registry import encryptor_registry
+
+
+# 分块加密超大图像
+# 输入和输出都通过np.memmap访问，每次只把一个tile_size*tile_size的块读入内存并加密/解密
+# 每个块使用encryptor.sys.derive(块编号)派生出的序列，因此峰值内存只由块大小决定
+
+
+def open_input(path, shape=None, dtype='uint8'):
+    '''
+    以只读的memmap打开输入
+    .npy文件自带shape和dtype；其他文件视为原始的像素数据，需要传入shape和dtype
+    '''
+    if str(path).endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+    if shape is None:
+        raise ValueError(f'shape is required for raw input {path}')
+    return np.memmap(path, dtype=dtype, mode='r', shape=tuple(shape))
+
+
+def open_output(path, shape, dtype):  # 创建可写的memmap，.npy文件带有文件头，其他文件为原始数据
+    if str(path).endswith('.npy'):
+        return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+    return np.memmap(path, dtype=dtype, mode='w+', shape=shape)
+
+
+def iter_tiles(shape, tile_size):  # 按行优先的顺序返回每个块的编号和切片
+    index = 0
+    for i in range(0, shape[0], tile_size):
+        for j in range(0, shape[1], tile_size):
+            yield index, (slice(i, i + tile_size), slice(j, j + tile_size))
+            index += 1
+
+
+def process_tiled(encryptor, src, dst, tile_size=1024, decrypt=False, shape=None, dtype='uint8', out_dtype=None):
+    '''
+    分块加密/解密src，结果写入dst，返回输出的memmap
+    encryptor: 基于序列发生器的加密器，其中的操作都不能改变图像的shape
+    shape, dtype: src为原始数据文件时，图像的shape和dtype
+    out_dtype: 输出的dtype，默认与第一个块的结果相同；解密时可指定为uint8，此时结果会被取整并截断到[0, 255]
+    '''
+    if not isinstance(encryptor, encrypt.BaseSequenceEncryptor):
+        raise TypeError(f'{encryptor.__class__.__name__} does not support tiled encryption')
+    rgb = open_input(src, shape, dtype)
+    out = None
+    for index, region in iter_tiles(rgb.shape, tile_size):
+        sys = encryptor.sys.derive(index)  # 每个块使用各自派生出的序列
+        tile = np.asarray(rgb[region])
+        result = encryptor.decrypt_with(tile, sys) if decrypt else encryptor.encrypt_with(tile, sys)
+        if out is None:  # 由第一个块的结果确定输出的dtype
+            out = open_output(dst, rgb.shape, out_dtype or result.dtype)
+        if out.dtype == np.uint8 and result.dtype != np.uint8:
+            result = np.clip(np.round(np.real(result)), 0, 255)
+        out[region] = result
+    if out is not None:
+        out.flush()
+    return out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='分块加密/解密超大图像')
+    parser.add_argument('mode', choices=['encrypt', 'decrypt'])
+    parser.add_argument('src', help='输入文件，.npy或原始像素数据')
+    parser.add_argument('dst', help='输出文件，.npy或原始像素数据')
+    parser.add_argument('--encryptor', default='ClassicChaos', help='encryptor_registry中注册的加密器名称')
+    parser.add_argument('--args', default='[]', help='加密器的位置参数，JSON列表')
+    parser.add_argument('--kwargs', default='{}', help='加密器的关键字参数，JSON对象')
+    parser.add_argument('--tile', type=int, default=1024, help='块的边长')
+    parser.add_argument('--shape', type=int, nargs='+', default=None, help='原始数据输入的shape，如 H W C')
+    parser.add_argument('--dtype', default='uint8', help='原始数据输入的dtype')
+    parser.add_argument('--out-dtype', default=None, help='输出的dtype')
+    opt = parser.parse_args()
+    en = encryptor_registry.build(opt.encryptor, *json.loads(opt.args), **json.loads(opt.kwargs))
+    process_tiled(en, opt.src, opt.dst, opt.tile, opt.mode == 'decrypt', opt.shape, opt.dtype, opt.out_dtype)
@@ -1,7 +1,9 @@
+import functools
 import numpy as np
 import pywt
 import scipy
 import operation
+import instrument
 from registry import operation_registry
 
 
@@ -14,140 +16,275 @@ class BaseTransform(operation.BaseOperation):
         pass
 
     def __call__(self, rgb, it: iter, reverse=False):
-        if not reverse:
-            return self.forward(rgb)
-        else:
-            return self.backward(rgb)
+        with instrument.span('forward' if not reverse else 'backward', rgb=rgb):
+            if not reverse:
+                return self.forward(rgb)
+            else:
+                return self.backward(rgb)
         
     def get_cost(self, rgb):
         return 0
 
+    def compile(self, shape, it):
+        return [operation.TransformStep(self)]
 
-# 自己实现的离散余弦变换
-# 由于效率不如直接调库，所以该类暂时没有使用
+
+# 分块离散余弦变换，与JPEG相同，对每个block_size*block_size的块分别做二维离散余弦变换
+# 所有块、所有通道（以及所有图像）的变换通过与DCT基矩阵的批量矩阵乘法一次完成
+# 图像的高和宽不是block_size的整数倍时，右侧和下方不足一块的边缘保持不变，保证变换可逆且不改变图像的shape
+# RawDiscreteCosineTransform为原来逐块循环实现的名称，保留为别名
 @operation_registry.register('RawDiscreteCosineTransform')
-class DiscreteCosineTransform(BaseTransform):
-    def dct_2d(self, block):
-        N = block.shape[0]
-        dct_matrix = np.zeros((N, N), dtype=float)
-        for u in range(N):
-            for v in range(N):
-                sum = 0.0
-                for x in range(N):
-                    for y in range(N):
-                        sum += block[x, y] * np.cos((2*x + 1) * u * np.pi / (2 * N)) * np.cos((2*y + 1) * v * np.pi / (2 * N))
-                if u == 0:
-                    cu = np.sqrt(1 / N)
-                else:
-                    cu = np.sqrt(2 / N)
-                if v == 0:
-                    cv = np.sqrt(1 / N)
-                else:
-                    cv = np.sqrt(2 / N)
-                dct_matrix[u, v] = cu * cv * sum
-        return dct_matrix
-
-    def idct_2d(self, block):
-        N = block.shape[0]
-        idct_matrix = np.zeros((N, N), dtype=float)
-        for x in range(N):
-            for y in range(N):
-                sum = 0.0
-                for u in range(N):
-                    for v in range(N):
-                        if u == 0:
-                            cu = np.sqrt(1 / N)
-                        else:
-                            cu = np.sqrt(2 / N)
-                        if v == 0:
-                            cv = np.sqrt(1 / N)
-                        else:
-                            cv = np.sqrt(2 / N)
-                        sum += cu * cv * block[u, v] * np.cos((2 * x + 1) * u * np.pi / (2 * N)) * np.cos((2 * y + 1) * v * np.pi / (2 * N))
-                idct_matrix[x, y] = sum
-        return idct_matrix
-
-    def block_transform(self, image, block_size, transform_func):
-        h, w = image.shape
-
-        # 计算需要的填充量
-        h_pad = (block_size - (h % block_size)) % block_size
-        w_pad = (block_size - (w % block_size)) % block_size
-
-        # 对图片进行填充
-        padded_image = np.pad(image, ((0, h_pad), (0, w_pad)), mode='constant', constant_values=0)
-
-        # 进行变换
-        padded_h, padded_w = padded_image.shape
-        transformed_image = np.zeros((padded_h, padded_w), dtype=float)
-        for i in range(0, padded_h, block_size):
-            for j in range(0, padded_w, block_size):
-                block = padded_image[i:i+block_size, j:j+block_size]
-                transformed_image[i:i+block_size, j:j+block_size] = transform_func(block)
-
-        # 去掉填充部分
-        transformed_image = transformed_image[:h, :w]
-        return transformed_image
+@operation_registry.register('BlockDiscreteCosineTransform')
+class BlockDiscreteCosineTransform(BaseTransform):
+    def __init__(self, block_size=8, times=1):
+        super().__init__(times)
+        self.block_size = block_size
 
-    def forward(self, rgb):
-        transformed_rgb = np.copy(rgb).astype(np.float)
-        for layer_id in range(rgb.shape[2]):
-            layer = rgb[:, :, layer_id]
-            transformed_rgb[:, :, layer_id] = self.block_transform(layer, 8, DiscreteCosineTransform.dct_2d)
-        return transformed_rgb
+    @staticmethod
+    @functools.lru_cache
+    def dct_basis(N):  # 正交的DCT-II基矩阵，D[u, x] = c(u) * cos((2x + 1) * u * pi / 2N)
+        x = np.arange(N)
+        basis = np.cos((2 * x[None, :] + 1) * x[:, None] * np.pi / (2 * N))
+        basis[0] *= np.sqrt(1 / N)
+        basis[1:] *= np.sqrt(2 / N)
+        basis.setflags(write=False)
+        return basis
+
+    def block_transform(self, rgb, matrix):
+        '''
+        对rgb（shape为[..., H, W, C]）中的每一块计算 matrix @ block @ matrix.T
+        正变换时matrix为DCT基矩阵，逆变换时为其转置
+        '''
+        b = self.block_size
+        H, W, C = rgb.shape[-3:]
+        h, w = H - H % b, W - W % b  # 完整的块覆盖的区域
+        result = rgb.astype(float)
+        if h == 0 or w == 0:
+            return result
+        blocks = np.ascontiguousarray(result[..., :h, :w, :])
+        batch = blocks.shape[:-3]
+        # 每块的行是第-2维：[..., 块行, b, w*C]，左乘matrix即对所有块的每一列做变换
+        blocks = matrix @ blocks.reshape(batch + (h // b, b, w * C))
+        # 每块的列是第-2维：[..., h*块列, b, C]，再左乘matrix即对所有块的每一行做变换
+        blocks = matrix @ blocks.reshape(batch + (h * (w // b), b, C))
+        result[..., :h, :w, :] = blocks.reshape(batch + (h, w, C))
+        return result
+
+    def forward(self, rgb):  # 返回的是浮点值
+        return self.block_transform(rgb, self.dct_basis(self.block_size))
 
     def backward(self, rgb):
-        transformed_rgb = np.copy(rgb).astype(np.float)
-        for layer_id in range(rgb.shape[2]):
-            layer = rgb[:, :, layer_id]
-            transformed_rgb[:, :, layer_id] = self.block_transform(layer, 8, DiscreteCosineTransform.idct_2d)
-        return transformed_rgb
-        
+        return self.block_transform(rgb, self.dct_basis(self.block_size).T)
+
+
+# 变换域上使用的浮点类型，single为True时使用单精度以减少一半的内存
+def float_type(single):
+    return np.float32 if single else np.float64
+
 
 # 离散余弦变换
 @operation_registry.register('DiscreteCosineTransform')
 class ScipyDiscreteCosineTransform(BaseTransform):
+    # 沿两个空间轴做变换，image的shape为[..., H, W, C]，所有通道（以及所有图像）一次完成
+    def __init__(self, times=1, workers=None, single=False):
+        '''
+        workers: scipy.fft使用的线程数，None为单线程，-1为使用所有CPU
+        single: 是否在单精度(float32)上变换
+        '''
+        super().__init__(times)
+        self.workers = workers
+        self.single = single
+
     def dct_2d(self, image):
-        return scipy.fftpack.dct(scipy.fftpack.dct(image.T, norm='ortho').T, norm='ortho')
+        return scipy.fft.dctn(image, axes=(-3, -2), norm='ortho', workers=self.workers)
 
     def idct_2d(self, dct_image):
-        return scipy.fftpack.idct(scipy.fftpack.idct(dct_image.T, norm='ortho').T, norm='ortho')
+        return scipy.fft.idctn(dct_image, axes=(-3, -2), norm='ortho', workers=self.workers)
 
     def forward(self, rgb):  # 对RGB三个通道分别进行离散余弦变换，返回的是浮点值
-        transformed_rgb = np.zeros_like(rgb, dtype=float)
-        for layer_id in range(rgb.shape[2]):
-            layer = rgb[:, :, layer_id]
-            transformed_rgb[:, :, layer_id] = self.dct_2d(layer)
-        return transformed_rgb
+        return self.dct_2d(rgb.astype(float_type(self.single)))
 
     def backward(self, transformed_rgb):  # 逆离散余弦变换
-        reconstructed_rgb = np.zeros_like(transformed_rgb, dtype=float)
-        for layer_id in range(transformed_rgb.shape[2]):
-            layer = transformed_rgb[:, :, layer_id]
-            reconstructed_rgb[:, :, layer_id] = self.idct_2d(layer)
-        return reconstructed_rgb
+        return self.idct_2d(transformed_rgb)
 
 
 # 傅立叶变换
 @operation_registry.register('FourierTransform')
 class FourierTransform(BaseTransform):
+    # real为True时利用输入是实数的性质，使用实数傅立叶变换(rfft2)，只计算宽度方向上的一半频谱Y[:, 0..W/2]
+    # 这一半频谱恰好由H*W个实数决定，按以下方式排列为与输入shape相同的实数数组：
+    #   第0列（以及W为偶数时的第W/2列）沿高度方向共轭对称，按 [Re y0, Re y1, Im y1, Re y2, Im y2, ...] 排列为H个实数，
+    #   分别放在第0列和第W-1列；其余各列的实部和虚部依次放在第1, 2, 3, 4...列
+    # 因此变换域与原图像的shape相同，且每个值只占一个浮点数，而不是完整频谱的一个复数
+    # real为False时使用完整的复数频谱
+    def __init__(self, times=1, workers=None, single=False, real=True):
+        '''
+        workers: scipy.fft使用的线程数，None为单线程，-1为使用所有CPU
+        single: 是否在单精度(float32/complex64)上变换
+        '''
+        super().__init__(times)
+        self.workers = workers
+        self.single = single
+        self.real = real
+
+    @staticmethod
+    def pack_hermitian(spectrum, n):  # 把共轭对称的长度为n的频谱（沿第0维）排列为n个实数
+        packed = np.empty((n,) + spectrum.shape[1:], dtype=spectrum.real.dtype)
+        packed[0] = spectrum[0].real
+        packed[1::2] = spectrum[1:1 + n // 2].real
+        packed[2::2] = spectrum[1:1 + (n - 1) // 2].imag
+        return packed
+
+    @staticmethod
+    def unpack_hermitian(packed, dtype):  # pack_hermitian的逆过程，返回完整的频谱
+        n = len(packed)
+        spectrum = np.empty(packed.shape, dtype=dtype)
+        spectrum[0] = packed[0]
+        spectrum.real[1:1 + n // 2] = packed[1::2]
+        spectrum.imag[1:1 + n // 2] = 0
+        spectrum.imag[1:1 + (n - 1) // 2] = packed[2::2]
+        spectrum[n // 2 + 1:] = np.conj(spectrum[1:(n + 1) // 2][::-1])  # 后一半与前一半共轭对称
+        return spectrum
+
     def fft_2d(self, image):
-        return np.fft.fft2(image)
+        if not self.real:
+            return scipy.fft.fft2(image, axes=(-3, -2), workers=self.workers)
+        H, W = image.shape[-3:-1]
+        spectrum = np.moveaxis(scipy.fft.rfft2(image, axes=(-3, -2), workers=self.workers), (-3, -2), (0, 1))
+        packed = np.empty((H, W) + spectrum.shape[2:], dtype=spectrum.real.dtype)
+        k = (W - 1) // 2  # 实部和虚部都需要保存的列数
+        packed[:, 0] = self.pack_hermitian(spectrum[:, 0], H)
+        packed[:, 1:1 + 2 * k:2] = spectrum[:, 1:1 + k].real
+        packed[:, 2:2 + 2 * k:2] = spectrum[:, 1:1 + k].imag
+        if W % 2 == 0 and W > 1:  # 第W/2列
+            packed[:, W - 1] = self.pack_hermitian(spectrum[:, W // 2], H)
+        return np.moveaxis(packed, (0, 1), (-3, -2))
 
     def ifft_2d(self, freq_domain_image):
-        return np.fft.ifft2(freq_domain_image)
+        if not self.real:
+            return scipy.fft.ifft2(freq_domain_image, axes=(-3, -2), workers=self.workers)
+        H, W = freq_domain_image.shape[-3:-1]
+        packed = np.moveaxis(freq_domain_image, (-3, -2), (0, 1))
+        dtype = np.complex64 if packed.dtype == np.float32 else np.complex128
+        spectrum = np.empty((H, W // 2 + 1) + packed.shape[2:], dtype=dtype)
+        k = (W - 1) // 2
+        spectrum[:, 0] = self.unpack_hermitian(packed[:, 0], dtype)
+        spectrum.real[:, 1:1 + k] = packed[:, 1:1 + 2 * k:2]
+        spectrum.imag[:, 1:1 + k] = packed[:, 2:2 + 2 * k:2]
+        if W % 2 == 0 and W > 1:
+            spectrum[:, W // 2] = self.unpack_hermitian(packed[:, W - 1], dtype)
+        spectrum = np.moveaxis(spectrum, (0, 1), (-3, -2))
+        return scipy.fft.irfft2(spectrum, s=(H, W), axes=(-3, -2), workers=self.workers)
 
-    def forward(self, rgb):  # 对RGB三个通道分别进行傅立叶变换，返回的是复数值
-        transformed_rgb = np.zeros_like(rgb, dtype=complex)
-        for layer_id in range(rgb.shape[2]):
-            layer = rgb[:, :, layer_id]
-            transformed_rgb[:, :, layer_id] = self.fft_2d(layer)
-        return transformed_rgb
+    def forward(self, rgb):  # 对RGB三个通道分别进行傅立叶变换，real为True时返回的是实数值，否则为复数值
+        return self.fft_2d(rgb.astype(float_type(self.single)))
 
     def backward(self, transformed_rgb):  # 逆傅立叶变换
-        reconstructed_rgb = np.zeros_like(transformed_rgb, dtype=float)
-        for layer_id in range(transformed_rgb.shape[2]):
-            layer = transformed_rgb[:, :, layer_id]
-            reconstructed_rgb[:, :, layer_id] = np.abs(self.ifft_2d(layer))
-        return reconstructed_rgb
+        if not self.real:
+            return np.abs(self.ifft_2d(transformed_rgb))
+        return self.ifft_2d(transformed_rgb)
+
+
+# 小波子带上的加密步骤
+class SubbandStep(operation.BaseStep):
+    def __init__(self, transform, steps):
+        self.transform = transform  # WaveletSubbandOperation，负责分解与重建
+        self.steps = steps  # 按正向顺序排列的(子带名称, 加密步骤)
+
+    def forward(self, rgb):
+        bands, rgb = self.transform.decompose(rgb)
+        for name, step in self.steps:
+            bands[name] = step.forward(bands[name])
+        return self.transform.reconstruct(bands, rgb)
+
+    def backward(self, rgb):
+        bands, rgb = self.transform.decompose(rgb)
+        for name, step in reversed(self.steps):
+            bands[name] = step.backward(bands[name])
+        return self.transform.reconstruct(bands, rgb)
+
+    def passes(self):  # 分解与重建，子带上的步骤只计一次
+        return 2 + sum(step.passes() for _, step in self.steps)
+
+    def optimize(self):  # 同一子带上相邻的步骤相互融合
+        steps = []
+        for name, step in self.steps:
+            if steps and steps[-1][0] == name:
+                steps[-1][1].append(step)
+            else:
+                steps.append((name, [step]))
+        return SubbandStep(self.transform, [(name, fused) for name, run in steps for fused in operation.fuse(run)])
+
+    def nbytes(self):
+        return sum(step.nbytes() for _, step in self.steps)
+
+
+# 小波子带选择性加密
+# 对图像做level层二维小波分解，只在选中的子带上执行op_list中的加密操作，其余子带保持不变，再重建图像
+# 子带名称：LL为第level层的近似子带，H{k}、V{k}、D{k}为第k层的水平、垂直、对角细节子带（k=1为最精细的一层）
+# 第level层的LL子带只有原图像的1/4^level大小，只加密LL子带时所需的序列和置换开销也相应减少
+# 高和宽不是2^level的整数倍时，右侧和下方多出的边缘保持不变，保证变换可逆且不改变图像的shape；高或宽小于2^level时该操作不做任何改变
+# 子带系数是浮点数，不能在其上执行Diffusion（见operation.DiffusionStep），只支持置换类的操作
+@operation_registry.register('WaveletSubband')
+class WaveletSubbandOperation(operation.BaseOperation):
+    def __init__(self, op_list, wavelet='haar', level=1, subbands=('LL',), times=1):
+        self.check(op_list)
+        self.op_list = op_list  # 在每个选中的子带上执行的操作
+        self.wavelet = wavelet  # pywt支持的小波名称
+        self.level = level
+        self.subbands = tuple(subbands)
+        self.times = times
+
+    @classmethod
+    def check(cls, op_list):  # 检查op_list（包括组合操作中的子操作）中没有Diffusion
+        for op in op_list:
+            if isinstance(op, operation.DiffusionOperation):
+                raise ValueError('Diffusion is not invertible on float wavelet coefficients')
+            cls.check(getattr(op, 'op_list', ()))
+
+    def region(self, shape):  # 参与小波分解的区域的高和宽
+        step = 1 << self.level
+        return shape[-3] - shape[-3] % step, shape[-2] - shape[-2] % step
+
+    def band_shape(self, shape, name):  # 子带的shape
+        k = self.level if name == 'LL' else int(name[1:])
+        h, w = self.region(shape)
+        return tuple(shape[:-3]) + (h >> k, w >> k, shape[-1])
+
+    def decompose(self, rgb):  # 返回各子带以及浮点化后的图像
+        rgb = rgb.astype(float)
+        h, w = self.region(rgb.shape)
+        coeffs = pywt.wavedec2(rgb[..., :h, :w, :], self.wavelet, mode='periodization', level=self.level, axes=(-3, -2))
+        bands = {'LL': coeffs[0]}
+        for i, details in enumerate(coeffs[1:]):  # coeffs[1]为第level层，coeffs[-1]为第1层
+            for d, band in zip('HVD', details):
+                bands[f'{d}{self.level - i}'] = band
+        return bands, rgb
+
+    def reconstruct(self, bands, rgb):  # 用各子带重建图像，写回rgb中参与分解的区域
+        coeffs = [bands['LL']]
+        for k in range(self.level, 0, -1):
+            coeffs.append(tuple(bands[f'{d}{k}'] for d in 'HVD'))
+        h, w = self.region(rgb.shape)
+        rgb[..., :h, :w, :] = pywt.waverec2(coeffs, self.wavelet, mode='periodization', axes=(-3, -2))
+        return rgb
+
+    def get_cost(self, rgb):
+        if 0 in self.region(rgb.shape):  # 高或宽小于2^level时没有参与分解的区域
+            return 0
+        cost = 0
+        for name in self.subbands:
+            band = np.broadcast_to(np.zeros((), float), self.band_shape(rgb.shape, name))
+            for op in self.op_list:
+                cost += op.get_cost(band)
+        return cost * self.times
 
+    def compile(self, shape, it):  # 每一轮依次处理每个选中的子带，在每个子带上依次执行每个操作
+        if 0 in self.region(shape):  # 高或宽小于2^level时整个图像保持不变
+            return []
+        steps = []
+        for _ in range(self.times):
+            for name in self.subbands:
+                for op in self.op_list:
+                    steps += [(name, step) for step in op.compile(self.band_shape(shape, name), it)]
+        return [SubbandStep(self, steps)]
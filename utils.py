@@ -1,19 +1,39 @@
-from PIL import Image
 import numpy as np
-import encrypt
 import math
+import os
 
 
 # 从文件读取图像并转换为RGB三通道的numpy数组
 def read_rgb(path):
+    from PIL import Image  # 只在读写图像文件时导入PIL，加快命令行工具和工作进程的启动
     image = Image.open(path)
     out = image.convert("RGB")
     return np.array(out)
 
 
+# 读取图像或数组：.npy文件（如变换域上的密文）直接读取为数组，其他文件按图像读取
+def read_array(path):
+    if str(path).endswith('.npy'):
+        return np.load(path)
+    return read_rgb(path)
+
+
+# 保存图像或数组：uint8图像保存为无损的PNG文件，其他类型（如变换域上的密文）保存为.npy文件
+# 返回实际保存的路径
+def save_array(rgb, path):
+    path = os.path.splitext(path)[0] + ('.png' if rgb.dtype == np.uint8 else '.npy')
+    if rgb.dtype == np.uint8:
+        from PIL import Image
+        Image.fromarray(rgb).save(path)
+    else:
+        np.save(path, rgb)
+    return path
+
+
 # 展示RGB图像
 def show_rgb(rgb):
     arr = np.asarray(np.clip(rgb, 0, 255).astype(np.uint8))  # 基于变换域的加密会返回浮点值，要先离散化
+    from PIL import Image
     img = Image.fromarray(arr)
     img.show()
 
@@ -40,6 +60,19 @@ def discrete(timestep):
     return math.floor(256 * sum) % 256
 
 
+# discrete的批量版本，返回uint8数组
+# 传入shape为[length, num_maps]的混沌序列，或shape为[length]的随机数序列
+def discrete_array(sequence):
+    sequence = np.asarray(sequence)
+    if sequence.ndim == 2:  # 混沌序列，逐列累加以保持与discrete相同的浮点运算顺序
+        sum = np.zeros(sequence.shape[0])
+        for column in sequence.T:
+            sum += 256 * column
+    else:  # 随机数序列
+        sum = sequence
+    return (np.floor(256 * sum) % 256).astype(np.uint8)
+
+
 # 把RGB表示的图像转换为YUV表示
 def rgb_to_yuv(image_rgb):
     image_rgb_copy = image_rgb.copy().astype(np.float)